@@ -0,0 +1,172 @@
+import collections
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import msgpack
+
+SERVER_VERSION = "99.0.0"
+COMPLETION_KINDS = ("method", "value", "class", "trait", "object")
+ASK_ENDPOINTS = (
+    "/ask-type-at",
+    "/ask-kind-at",
+    "/ask-fully-qualified-name-at",
+    "/ask-doc-at",
+)
+
+
+def encode_both(data):
+    return json.dumps(data).encode("utf-8"), msgpack.packb(data, use_bin_type=True)
+
+
+# stands in for scalavista-server: same endpoints and payload shapes, with
+# configurable latency and payload sizes; wire_formats ("msgpack", "gzip")
+# are offered to the plugin through /capabilities
+class MockServer(object):
+    def __init__(self, uuid, latency=0.0, message_size=40, wire_formats=()):
+        self.uuid = uuid
+        self.latency = latency
+        self.message_size = message_size
+        self.capabilities = ["reload-files"] + list(wire_formats)
+        self.lock = threading.Condition()
+        self.requests = collections.Counter()
+        self.contents = {}
+        self.set_diagnostics([], 0)
+        self.set_completions(0)
+        self.httpd = ThreadingHTTPServer(("localhost", 0), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def set_diagnostics(self, files, count, seed=0):
+        errors = []
+        for i in range(count):
+            path, n_lines = files[i % len(files)]
+            lnum = (i // len(files)) % n_lines + 1
+            col = 1 + (i + seed) % 20
+            start = 2 * col
+            text = "error {} ({}): ".format(i, seed).ljust(self.message_size, "x")
+            severity = "ERROR" if i % 3 else "WARNING"
+            errors.append([path, lnum, col, start, start + 8, text, severity])
+        with self.lock:
+            self.errors_bodies = encode_both(errors)
+            self.errors_etag = '"{}-{}"'.format(count, seed)
+
+    def set_completions(self, count):
+        candidates = [
+            [
+                "member{}".format(i),
+                ": Int".ljust(self.message_size, "x"),
+                COMPLETION_KINDS[i % len(COMPLETION_KINDS)],
+            ]
+            for i in range(count)
+        ]
+        with self.lock:
+            self.completions_bodies = encode_both(candidates)
+
+    def wait_for(self, predicate, timeout):
+        with self.lock:
+            return self.lock.wait_for(lambda: predicate(self), timeout)
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, body, status=200, content_type="application/json"):
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                if (
+                    "gzip" in server.capabilities
+                    and "gzip" in self.headers.get("Accept-Encoding", "")
+                    and len(body) > 1024
+                ):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                if self.path == "/errors" and status == 200:
+                    self.send_header("ETag", server.errors_etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def respond_data(self, bodies):
+                json_body, msgpack_body = bodies
+                if (
+                    "msgpack" in server.capabilities
+                    and "application/msgpack" in self.headers.get("Accept", "")
+                ):
+                    self.respond(msgpack_body, content_type="application/msgpack")
+                else:
+                    self.respond(json_body)
+
+            def read_data(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                if not body:
+                    return {}
+                if self.headers.get("Content-Type") == "application/msgpack":
+                    return msgpack.unpackb(body, raw=False)
+                return json.loads(body)
+
+            def record(self, data=None):
+                with server.lock:
+                    server.requests[self.path] += 1
+                    if self.path == "/reload-file":
+                        server.contents[data["filename"]] = data["fileContents"]
+                    elif self.path == "/reload-files":
+                        for f in data["files"]:
+                            server.contents[f["filename"]] = f["fileContents"]
+                    server.lock.notify_all()
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                if self.path == "/alive":
+                    self.respond(server.uuid, content_type="text/plain")
+                elif self.path == "/version":
+                    self.respond(SERVER_VERSION, content_type="text/plain")
+                elif self.path == "/capabilities":
+                    self.respond(json.dumps(server.capabilities))
+                elif self.path == "/errors":
+                    with server.lock:
+                        etag, bodies = server.errors_etag, server.errors_bodies
+                    if self.headers.get("If-None-Match") == etag:
+                        self.respond(b"", status=304)
+                    else:
+                        self.respond_data(bodies)
+                else:
+                    self.respond(b"", status=404)
+                self.record()
+
+            def do_POST(self):
+                data = self.read_data()
+                time.sleep(server.latency)
+                if self.path in ("/reload-file", "/reload-files"):
+                    self.respond(b"")
+                elif self.path in ("/type-completion", "/scope-completion"):
+                    self.respond_data(server.completions_bodies)
+                elif self.path == "/ask-pos-at":
+                    self.respond_data(encode_both({"file": "", "line": 0, "column": 0}))
+                elif self.path in ASK_ENDPOINTS:
+                    self.respond(
+                        "Int".ljust(server.message_size, "x"), content_type="text/plain"
+                    )
+                else:
+                    self.respond(b"", status=404)
+                self.record(data)
+
+        return Handler
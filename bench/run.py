@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# Drives the plugin inside an embedded nvim against the mock server and
+# writes one JSON object per measurement, e.g.
+#
+#   python3 bench/run.py --output bench_output.txt
+#
+# Requires nvim and pynvim; no Java or scalavista-server needed.
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import pynvim
+
+from mock_server import MockServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCALA_VERSION = "2.13"
+SERVER_JAR = "scalavista-server-{}_{}.jar".format("99.0.0", SCALA_VERSION)
+PERCENTILES = (50, 95, 99)
+
+INIT_VIM = """
+set nocompatible
+set runtimepath^={repo}
+set noswapfile
+set shortmess+=A
+let g:python3_host_prog = '{python}'
+let g:scalavista_shared_server = 1
+let g:scalavista_preload = 0
+let g:scalavista_symbol_index = 0
+let g:scalavista_sync_debounce_ms = {debounce}
+let g:scalavista_trace_file = '{trace}'
+"""
+
+FAKE_JAVA = """#!/bin/sh
+echo 'openjdk version "17.0.2"' >&2
+"""
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    result = {
+        "p{}".format(p): 1000
+        * samples[min(len(samples) - 1, len(samples) * p // 100)]
+        for p in PERCENTILES
+    }
+    result["max"] = 1000 * samples[-1]
+    return result
+
+
+class Bench(object):
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.results = []
+        self.project = os.path.join(workdir, "project")
+        self.trace_path = os.path.join(workdir, "trace.jsonl")
+        self.source = os.path.join(self.project, "src", "Main.scala")
+        self.uuid = uuid.uuid4().hex
+        self.server = MockServer(
+            self.uuid,
+            latency=args.latency_ms / 1000,
+            message_size=args.message_size,
+            wire_formats=args.wire_formats,
+        )
+        self.fake_server_process = None
+        self.nvim = None
+
+    def report(self, scenario, **fields):
+        result = dict(scenario=scenario, **fields)
+        self.results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+    def write_project(self):
+        os.makedirs(os.path.dirname(self.source))
+        with open(os.path.join(self.project, "scalavista.json"), "w") as f:
+            json.dump({"scalaBinaryVersion": SCALA_VERSION}, f)
+        # only the file name matters - the plugin attaches to the mock instead
+        open(os.path.join(self.project, SERVER_JAR), "w").close()
+        with open(self.source, "w") as f:
+            f.write("object Main {\n")
+            for i in range(self.args.lines):
+                f.write("  val value{} = {} + {}\n".format(i, i, i))
+            f.write("}\n")
+        bin_dir = os.path.join(self.workdir, "bin")
+        os.makedirs(bin_dir)
+        java = os.path.join(bin_dir, "java")
+        with open(java, "w") as f:
+            f.write(FAKE_JAVA)
+        os.chmod(java, 0o755)
+
+    def environment(self):
+        env = dict(os.environ)
+        for name in [
+            "XDG_CONFIG_HOME",
+            "XDG_DATA_HOME",
+            "XDG_STATE_HOME",
+            "XDG_CACHE_HOME",
+        ]:
+            env[name] = os.path.join(self.workdir, name.lower())
+        env["XDG_RUNTIME_DIR"] = os.path.join(self.workdir, "run")
+        env["NVIM_RPLUGIN_MANIFEST"] = os.path.join(self.workdir, "rplugin.vim")
+        env["PATH"] = os.path.join(self.workdir, "bin") + os.pathsep + env["PATH"]
+        return env
+
+    def register_mock_server(self, env):
+        # mirrors ServerRegistry: the plugin attaches to a live shared server
+        # instead of launching one; the placeholder pid is what it kills on exit,
+        # and the bench itself counts as a live client so that it isn't reaped
+        self.fake_server_process = subprocess.Popen(
+            ["sleep", "86400"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        key = hashlib.sha1(
+            "{}\0{}".format(self.project, SCALA_VERSION).encode("utf-8")
+        ).hexdigest()[:16]
+        directory = os.path.join(env["XDG_RUNTIME_DIR"], "scalavista")
+        os.makedirs(directory, mode=0o700)
+        entry = {
+            "port": self.server.port,
+            "uuid": self.uuid,
+            "pid": self.fake_server_process.pid,
+            "clients": [os.getpid()],
+        }
+        with open(os.path.join(directory, "server-{}.json".format(key)), "w") as f:
+            json.dump(entry, f)
+
+    @contextlib.contextmanager
+    def session(self):
+        self.write_project()
+        env = self.environment()
+        self.register_mock_server(env)
+        try:
+            with self.nvim_session(env):
+                yield
+        finally:
+            self.fake_server_process.kill()
+            self.fake_server_process.wait()
+
+    @contextlib.contextmanager
+    def nvim_session(self, env):
+        init = os.path.join(self.workdir, "init.vim")
+        with open(init, "w") as f:
+            f.write(
+                INIT_VIM.format(
+                    repo=REPO,
+                    python=sys.executable,
+                    debounce=self.args.sync_debounce_ms,
+                    trace=self.trace_path,
+                )
+            )
+        nvim = [self.args.nvim, "-u", init, "-i", "NONE", "-n"]
+        subprocess.run(
+            nvim + ["--headless", "+UpdateRemotePlugins", "+qa!"],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        old_env = dict(os.environ)
+        os.environ.update(env)  # the child inherits the bench environment
+        self.server.start()
+        try:
+            self.nvim = pynvim.attach(
+                "child",
+                argv=nvim + ["--embed", "--headless", "--cmd", "cd " + self.project],
+            )
+            yield
+        finally:
+            if self.nvim is not None:
+                with contextlib.suppress(Exception):
+                    self.nvim.command("qa!")
+                self.nvim.close()
+            os.environ.clear()
+            os.environ.update(old_env)
+            self.server.stop()
+
+    def wait(self, predicate, what):
+        deadline = time.perf_counter() + self.args.timeout
+        while not predicate():
+            if time.perf_counter() > deadline:
+                raise RuntimeError("timed out waiting for {}".format(what))
+            time.sleep(0.001)
+
+    def barrier(self):
+        # the only synchronous plugin entry point: returns once the plugin
+        # host has worked through everything nvim sent it before
+        self.nvim.call("ScalavistaCompleteFunc", 1, "")
+
+    def server_has(self, marker):
+        return marker in self.server.contents.get(self.source, "")
+
+    def attach(self):
+        start = time.perf_counter()
+        self.nvim.command("edit " + self.source)
+        self.server.wait_for(lambda s: self.source in s.contents, self.args.timeout)
+        self.report("attach", ms=1000 * (time.perf_counter() - start))
+
+    def typing_bursts(self):
+        latencies = []
+        chars = 0
+        start = time.perf_counter()
+        for i in range(self.args.bursts):
+            marker = "burst{}x".format(i)
+            keys = "{}ggo  val {} = {}<Esc>".format(
+                2 + (i * 7919) % self.args.lines, marker, "1 + " * 10 + "1"
+            )
+            chars += len(keys)
+            sent = time.perf_counter()
+            self.nvim.input(keys)
+            self.wait(lambda: self.server_has(marker), "reload of " + marker)
+            latencies.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        self.report(
+            "typing_burst",
+            lines=self.args.lines,
+            bursts=self.args.bursts,
+            keys_per_s=chars / elapsed,
+            reload_ms=percentiles(latencies),
+        )
+
+    def diagnostics(self, count):
+        files = [(self.source, self.args.lines)] + [
+            (os.path.join(self.project, "src", "Other{}.scala".format(i)), 100)
+            for i in range(9)
+        ]
+        latencies = []
+        for seed in range(self.args.repeat):
+            # read first: a refresh poll may render the new set before
+            # :ScalavistaErrors runs, which then gets a 304 and changes nothing
+            tick = self.nvim.call("getqflist", {"changedtick": 0})["changedtick"]
+            self.server.set_diagnostics(files, count, seed)
+
+            def rendered():
+                qf = self.nvim.call("getqflist", {"changedtick": 0, "size": 0})
+                return qf["changedtick"] != tick and qf["size"] == count
+
+            sent = time.perf_counter()
+            self.nvim.command("ScalavistaErrors")
+            self.wait(rendered, "{} diagnostics".format(count))
+            self.barrier()
+            latencies.append(time.perf_counter() - sent)
+        self.report("diagnostics", count=count, render_ms=percentiles(latencies))
+
+    def completions(self):
+        self.server.set_completions(self.args.completions)
+        self.nvim.command("normal! 2G$")
+        cold = []
+        warm = []
+        for i in range(self.args.repeat):
+            self.nvim.command("normal! ax")  # a new changedtick defeats the cache
+            start = time.perf_counter()
+            self.nvim.call("ScalavistaCompleteFunc", 0, "")
+            cold.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            self.nvim.call("ScalavistaCompleteFunc", 0, "mem")
+            warm.append(time.perf_counter() - start)
+        self.report(
+            "completion",
+            candidates=self.args.completions,
+            cold_ms=percentiles(cold),
+            cached_ms=percentiles(warm),
+        )
+
+    def cursor_storm(self):
+        storm = """
+        local lines = vim.api.nvim_buf_line_count(0)
+        for i = 1, ... do
+            vim.api.nvim_win_set_cursor(0, {(i * 31) % lines + 1, 0})
+            vim.cmd("doautocmd CursorMoved")
+        end
+        """
+        start = time.perf_counter()
+        self.nvim.exec_lua(storm, self.args.cursor_moves)
+        self.barrier()
+        elapsed = time.perf_counter() - start
+        self.report(
+            "cursor_storm",
+            moves=self.args.cursor_moves,
+            moves_per_s=self.args.cursor_moves / elapsed,
+        )
+
+    def hover(self):
+        latencies = []
+        cached = []
+        for i in range(self.args.repeat):
+            self.nvim.command("normal! {}G0w".format(2 + i))
+            served = self.server.requests["/ask-type-at"]
+            start = time.perf_counter()
+            self.nvim.command("ScalavistaType")
+            self.server.wait_for(
+                lambda s: s.requests["/ask-type-at"] > served, self.args.timeout
+            )
+            latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            self.nvim.command("ScalavistaType")
+            self.barrier()
+            cached.append(time.perf_counter() - start)
+        self.report(
+            "hover", cold_ms=percentiles(latencies), cached_ms=percentiles(cached)
+        )
+
+    def plugin_phases(self):
+        samples = {}
+        try:
+            with open(self.trace_path) as f:
+                for line in f:
+                    sample = json.loads(line)
+                    samples.setdefault(sample["phase"], []).append(sample["ms"] / 1000)
+        except OSError:
+            return
+        for phase in sorted(samples):
+            self.report(
+                "phase",
+                phase=phase,
+                count=len(samples[phase]),
+                ms=percentiles(samples[phase]),
+            )
+
+    def run(self):
+        with self.session():
+            self.attach()
+            self.typing_bursts()
+            for count in self.args.diagnostics:
+                self.diagnostics(count)
+            self.completions()
+            self.cursor_storm()
+            self.hover()
+        self.plugin_phases()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="neovim-scalavista benchmarks")
+    parser.add_argument("--nvim", default="nvim")
+    parser.add_argument("--output", default=os.path.join(REPO, "bench_output.txt"))
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--message-size", type=int, default=40)
+    parser.add_argument(
+        "--wire-formats", nargs="*", choices=["msgpack", "gzip"], default=[]
+    )
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--sync-debounce-ms", type=int, default=0)
+    parser.add_argument(
+        "--diagnostics", type=int, nargs="+", default=[10, 1000, 10000]
+    )
+    parser.add_argument("--completions", type=int, default=10000)
+    parser.add_argument("--cursor-moves", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+    if shutil.which(args.nvim) is None:
+        parser.error("{} not found - pass --nvim".format(args.nvim))
+
+    workdir = os.path.realpath(tempfile.mkdtemp(prefix="scalavista-bench-"))
+    bench = Bench(args, workdir)
+    try:
+        bench.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, "w") as f:
+        for result in bench.results:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
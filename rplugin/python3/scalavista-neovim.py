@@ -1,14 +1,52 @@
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import hashlib
+import heapq
 import json
 import os
 import re
 import random
 import inspect
+import itertools
+import queue
+import shutil
+import signal
+import socket
+import stat
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import uuid
+import zipfile
 import requests
 import pynvim
 from packaging.version import Version
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
+try:
+    import msgpack
+except ImportError:  # normally installed along with pynvim
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Lua buffer callbacks, nvim_exec_lua, sign_placelist and WinScrolled
+MIN_NVIM_VERSION = "nvim-0.5"
 MIN_PORT = 49152
 MAX_PORT = 65535
 
@@ -16,62 +54,1446 @@ INFO_PROMPT = "scalavista[info]>"
 WARNING_PROMPT = "scalavista[warn]>"
 ERROR_PROMPT = "scalavista[error]>"
 
+DEFAULT_SYNC_DEBOUNCE_MS = 300
+MIN_POLL_INTERVAL_MS = 500
+DEFAULT_MAX_POLL_INTERVAL_MS = 8000
+
+# servers with the "events" capability announce state changes on stdout as
+# lines of the form 'scalavista-event: {"type": "errors", ...}'
+EVENT_PREFIX = "scalavista-event:"
+
+# matched against server stdout to notice that the server is ready without
+# waiting for the next poll
+DEFAULT_READY_PATTERN = r"(?i)\b(listening|online|ready)\b"
+
+PROJECT_FILE = "scalavista.json"
+# a crashed server is restarted after 1s, 2s, 4s, ... up to a minute; a
+# server that stayed up for a while starts over at 1s
+RESTART_BACKOFF_BASE = 1.0
+RESTART_BACKOFF_MAX = 60.0
+MAX_SERVER_RESTARTS = 8
+STABLE_SERVER_SECONDS = 60.0
+DEFAULT_MAX_SERVERS = 2
+DEFAULT_SERVER_IDLE_TIMEOUT = 30 * 60
+# how often the registry is scanned for shared servers whose editors died
+ORPHAN_REAP_INTERVAL = 60.0
+
+SOURCE_EXTENSIONS = (".scala", ".java")
+SKIPPED_DIRECTORIES = {
+    ".git",
+    ".hg",
+    ".svn",
+    ".bloop",
+    ".bsp",
+    ".idea",
+    ".metals",
+    ".scalavista",
+    "node_modules",
+    "target",
+}
+PRELOAD_BATCH_BYTES = 1 << 20
+PRELOAD_BATCH_FILES = 64
+PRELOAD_PROGRESS_INTERVAL = 2.0
+
+MAX_SYMBOL_RESULTS = 200
+SYMBOL_INDEX_CHUNK = 200
+SYMBOL_PATTERN = re.compile(
+    r"\s*(?:@\w+(?:\([^)]*\))?\s+)*"
+    r"(?:(?:private|protected)(?:\[[\w.]*\])?\s+"
+    r"|(?:abstract|case|final|implicit|inline|lazy|opaque|open|override"
+    r"|public|sealed|static|transparent)\s+)*"
+    r"(class|trait|object|enum|interface|record|def|val|var|type|given)\s+"
+    r"([A-Za-z_$][\w$]*|`[^`]+`)"
+)
+PACKAGE_PATTERN = re.compile(r"\s*package\s+(object\s+)?([\w.$`]+)")
+TYPE_KINDS = ("class", "trait", "object", "enum", "interface", "record")
+# string and char literals and line comments, which may contain braces
+LITERAL_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])\'|//.*')
+
+SERVER_JAR_PATTERN = re.compile(r"scalavista-server-.*\.jar")
+SCALA_VERSION_PATTERN = re.compile(r"_(\d\.\d{1,2})\.jar")
+SCALAVISTA_VERSION_PATTERN = re.compile(r"\d+\.\d+\.\d+")
+JAVA_VERSION_PATTERN = re.compile(r'version "(\d+)(?:\.(\d+))?')
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+DEFAULT_MAX_COMPLETIONS = 100
+DEFAULT_HOVER_CACHE_SIZE = 256
+DEFAULT_HOVER_CACHE_TTL = 30.0
+COMPLETION_TYPES = ("type", "scope")
+
+SIGN_GROUP = "scalavista"
+SIGN_PRIORITIES = {"ERROR": 12, "WARNING": 11}
+DEFAULT_SIGN_PRIORITY = 10
+QUICKFIX_TITLE = "neovim-scalavista"
+DEFAULT_LAZY_DIAGNOSTICS_THRESHOLD = 1000
+# lines above and below a window that are drawn along with it
+VIEWPORT_MARGIN = 50
+DIAGNOSTICS_FILL_CHUNK = 500
+QUICKFIX_FILL_CHUNK = 2000
+FILL_INTERVAL_MS = 10
+
+# (connect, read) timeouts in seconds for requests to the scalavista server
+CONNECT_TIMEOUT = 0.5
+DEFAULT_READ_TIMEOUT = 5.0
+READ_TIMEOUTS = {
+    "/alive": 1.0,
+    "/version": 1.0,
+    "/capabilities": 1.0,
+    "/reload-file": 10.0,
+    "/reload-file-delta": 10.0,
+    "/reload-files": 30.0,
+}
+MAX_CLIENT_WORKERS = 4
+# request bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 16 * 1024
+
+DEFAULT_LOG_MAX_BYTES = 4 * 1024 * 1024
+LOG_BACKUPS = 3
+
+RELEASES_URL = "https://api.github.com/repos/buntec/scalavista-server/releases"
+UPDATE_CHECK_TIMEOUT = 5.0
+DEFAULT_UPDATE_CHECK_TTL = 24 * 60 * 60
+# (connect, read) - the read timeout applies between chunks, not to the whole jar
+DOWNLOAD_TIMEOUT = (10.0, 60.0)
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+STATS_WINDOW = 1000
+STATS_PERCENTILES = (50, 95, 99)
+
+# lower runs first: interactive requests overtake background traffic
+PRIORITY_COMPLETION = 0
+PRIORITY_QUERY = 1
+PRIORITY_RELOAD = 2
+PRIORITY_ERRORS = 3
+
+# buffer change events are forwarded from Lua because pynvim rplugins cannot
+# subscribe to nvim_buf_lines_event notifications directly
+BUF_ATTACH_LUA = """
+local bufnr = ...
+return vim.api.nvim_buf_attach(bufnr, false, {
+  on_lines = function(_, buf, tick, first, last, last_new)
+    vim.fn.ScalavistaOnLines(buf, tick, first, last, last_new)
+  end,
+  on_reload = function(_, buf)
+    vim.fn.ScalavistaOnReload(buf)
+  end,
+  on_detach = function(_, buf)
+    vim.fn.ScalavistaOnDetach(buf)
+  end,
+})
+"""
+
+VISIBLE_WINDOWS_LUA = """
+local tabnr = vim.fn.tabpagenr()
+local windows = {}
+for _, win in ipairs(vim.fn.getwininfo()) do
+  if win.tabnr == tabnr then
+    local name = vim.api.nvim_buf_get_name(win.bufnr)
+    table.insert(windows, {name, win.topline, win.botline})
+  end
+end
+return windows
+"""
+
+LOADED_BUFFERS_LUA = """
+local names = {}
+for _, buf in ipairs(vim.api.nvim_list_bufs()) do
+  if vim.api.nvim_buf_is_loaded(buf) then
+    table.insert(names, vim.api.nvim_buf_get_name(buf))
+  end
+end
+return names
+"""
+
+
+# the server indexes sources as JVM chars, i.e. UTF-16 code units
+def jvm_length(text):
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le", "surrogatepass")) // 2
+
+
+class BufferSnapshot(object):
+    def __init__(self, tick, lines):
+        self.tick = tick
+        self.lines = lines
+        self.content = "\n".join(lines)
+        # line_offsets[i] is the offset of the first char of line i + 1
+        line_offsets = [0] * (len(lines) + 1)
+        total = 0
+        for i, line in enumerate(lines):
+            total += jvm_length(line) + 1
+            line_offsets[i + 1] = total
+        self.line_offsets = line_offsets
+
+    def offset(self, cursor):
+        # cursor is (1-based line, 0-based byte column) as reported by nvim
+        row, col = cursor
+        line = self.lines[row - 1] if row <= len(self.lines) else ""
+        if not line.isascii():
+            prefix = line.encode("utf-8", "surrogateescape")[:col]
+            col = jvm_length(prefix.decode("utf-8", "ignore"))
+        return self.line_offsets[row - 1] + col
+
+
+class BufferSyncState(object):
+    def __init__(self, bufnr, filename, project):
+        self.bufnr = bufnr
+        self.filename = filename
+        self.project = project
+        self.synced_tick = None
+        self.needs_full = True
+        self.in_flight = False
+        self.snapshot = None
+        # bumped whenever the server-side copy is lost
+        self.epoch = 0
+        # (start, old_end, new_end): lines [start, old_end) of the last synced
+        # contents have been replaced by lines [start, new_end) of the buffer
+        self.dirty = None
+        # changedtick of the last on_lines event; dirty describes the buffer
+        # only as long as changedtick hasn't moved past it
+        self.edit_tick = None
+
+    def record_edit(self, first, last, last_new):
+        if self.dirty is None:
+            self.dirty = (first, last, last_new)
+            return
+        start, old_end, new_end = self.dirty
+        end = max(new_end, last)
+        self.dirty = (
+            min(start, first),
+            old_end + end - new_end,
+            end + last_new - last,
+        )
+
+    def invalidate(self):
+        self.epoch += 1
+        self.synced_tick = None
+        self.needs_full = True
+        self.dirty = None
+
+
+# rolling latency samples and counters, shared by the editor and worker threads
+class Stats(object):
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.trace_file = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.counters = collections.Counter()
+
+    def record(self, name, seconds):
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+            self.counters[name] += 1
+            if self.trace_file is not None:
+                self.trace_file.write(
+                    json.dumps(
+                        {"time": time.time(), "phase": name, "ms": seconds * 1000}
+                    )
+                    + "\n"
+                )
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            counters = dict(self.counters)
+        rows = []
+        for name in sorted(samples):
+            values = samples[name]
+            percentiles = [
+                values[min(len(values) - 1, len(values) * p // 100)]
+                for p in STATS_PERCENTILES
+            ]
+            rows.append((name, counters.pop(name), percentiles, values[-1]))
+        return rows, counters
+
+    def start_trace(self, path):
+        self.stop_trace()
+        with self.lock:
+            self.trace_file = open(path, "a", buffering=1)
+
+    def stop_trace(self):
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+
+
+class PriorityExecutor(object):
+    def __init__(self, max_workers):
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # key -> the most recently submitted job for that key
+        self.latest = {}
+        self.workers = [
+            threading.Thread(
+                target=self.work, name="scalavista-{}".format(i), daemon=True
+            )
+            for i in range(max_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, fn, args, priority, key=None):
+        future = concurrent.futures.Future()
+        job = (fn, args, future, key)
+        if key is not None:
+            with self.lock:
+                superseded = self.latest.get(key)
+                self.latest[key] = job
+            if superseded is not None:
+                superseded[2].cancel()  # no-op if it is already running
+        self.queue.put((priority, next(self.counter), job))
+        return future
+
+    def work(self):
+        while True:
+            _, _, job = self.queue.get()
+            if job is None:
+                return
+            fn, args, future, key = job
+            if key is not None:
+                with self.lock:
+                    if self.latest.get(key) is job:
+                        del self.latest[key]
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self):
+        for _ in self.workers:
+            self.queue.put((float("inf"), next(self.counter), None))
+
+
+# server output is appended to a size-capped log that rotates into
+# scalavista.log.1, .2, ...; the file is written on a thread of its own so
+# that a slow disk never holds up the editor
+class LogWriter(object):
+    def __init__(self, path, max_bytes=DEFAULT_LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue()
+        self.file = None
+        self.thread = threading.Thread(
+            target=self.work, name="scalavista-log", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, text):
+        self.queue.put(text)
+
+    def close(self, timeout=1.0):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def work(self):
+        while True:
+            text = self.queue.get()
+            if text is None:
+                break
+            try:
+                self.append(text)
+            except OSError:
+                pass  # logging must never take the plugin down
+        if self.file is not None:
+            self.file.close()
+
+    def append(self, text):
+        if self.file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(self.path, "a")
+        self.file.write(text)
+        self.file.flush()
+        if self.max_bytes > 0 and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            older = "{}.{}".format(self.path, i)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+
+def compress(encoding, body):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=1).compress(body)
+    return gzip.compress(body, compresslevel=1)
+
+
+class ServerClient(object):
+    def __init__(self, base_url, stats, max_workers=MAX_CLIENT_WORKERS):
+        self.base_url = base_url
+        self.stats = stats
+        self.session = requests.Session()
+        # only ever talks to localhost, so skip the proxy/netrc lookups
+        self.session.trust_env = False
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_workers
+        )
+        self.session.mount("http://", adapter)
+        self.executor = PriorityExecutor(max_workers)
+        # negotiated through /capabilities once the server is up; plain JSON
+        # until then and for servers that offer nothing else
+        self.msgpack = False
+        self.compression = None
+
+    def negotiate(self, capabilities):
+        self.msgpack = msgpack is not None and "msgpack" in capabilities
+        if zstandard is not None and "zstd" in capabilities:
+            self.compression = "zstd"
+        elif "gzip" in capabilities:
+            self.compression = "gzip"
+        else:
+            self.compression = None
+
+    def timeout(self, endpoint):
+        return (CONNECT_TIMEOUT, READ_TIMEOUTS.get(endpoint, DEFAULT_READ_TIMEOUT))
+
+    def headers(self, extra=None):
+        headers = {}
+        if self.msgpack:
+            headers["Accept"] = "application/msgpack, application/json"
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def get(self, endpoint, headers=None, **kwargs):
+        with self.stats.timed("http " + endpoint):
+            return self.session.get(
+                self.base_url + endpoint,
+                headers=self.headers(headers),
+                timeout=self.timeout(endpoint),
+                **kwargs
+            )
+
+    def post(self, endpoint, data, headers=None, **kwargs):
+        headers = self.headers(headers)
+        if self.msgpack:
+            with self.stats.timed("msgpack.encode " + endpoint):
+                body = msgpack.packb(data, use_bin_type=True)
+            headers["Content-Type"] = "application/msgpack"
+        else:
+            with self.stats.timed("json.encode " + endpoint):
+                body = json.dumps(data).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        if self.compression is not None and len(body) >= COMPRESS_MIN_BYTES:
+            with self.stats.timed(self.compression + " " + endpoint):
+                body = compress(self.compression, body)
+            headers["Content-Encoding"] = self.compression
+        with self.stats.timed("http " + endpoint):
+            return self.session.post(
+                self.base_url + endpoint,
+                data=body,
+                headers=headers,
+                timeout=self.timeout(endpoint),
+                **kwargs
+            )
+
+    def decode(self, endpoint, response):
+        if response.headers.get("Content-Type", "").startswith("application/msgpack"):
+            with self.stats.timed("msgpack.decode " + endpoint):
+                return msgpack.unpackb(response.content, raw=False)
+        with self.stats.timed("json.decode " + endpoint):
+            return response.json()
+
+    # replies that are a single string arrive as plain text, or encoded once
+    # the server honours the msgpack Accept header
+    def text(self, endpoint, response):
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith(("application/msgpack", "application/json")):
+            try:
+                value = self.decode(endpoint, response)
+            except ValueError:
+                return response.text  # plain text labelled as JSON
+            return value if isinstance(value, str) else str(value)
+        return response.text
+
+    def submit(self, fn, *args, priority=PRIORITY_QUERY, key=None):
+        return self.executor.submit(fn, args, priority, key)
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+Diagnostic = collections.namedtuple(
+    "Diagnostic", ["path", "lnum", "col", "start", "end", "text", "severity"]
+)
+
+
+def parse_diagnostic(error):
+    path, lnum, col, start, end, text, severity = error
+    return Diagnostic(
+        sys.intern(path),
+        int(lnum),
+        int(col),
+        int(start),
+        int(end),
+        text,
+        sys.intern(severity),
+    )
+
+
+# the decoder hands out a fresh copy of the path and severity of every entry;
+# interned, thousands of diagnostics of a file share a single string
+def parse_diagnostics(errors):
+    if errors and isinstance(errors[0][1], int):
+        # typed formats (msgpack, newer servers' JSON) need no conversion
+        intern = sys.intern
+        return [
+            Diagnostic(intern(path), lnum, col, start, end, text, intern(severity))
+            for path, lnum, col, start, end, text, severity in errors
+        ]
+    return [parse_diagnostic(error) for error in errors]
+
+
+def quickfix_items(diagnostics):
+    return [
+        {
+            "filename": diagnostic.path,
+            "lnum": diagnostic.lnum,
+            "text": diagnostic.severity + ":" + diagnostic.text,
+        }
+        for diagnostic in diagnostics
+    ]
+
+
+def pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "scalavista")
+
+
+def detect_java_version():
+    try:
+        result = subprocess.run(
+            ["java", "-version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=10,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = JAVA_VERSION_PATTERN.search(result.stdout.decode("utf-8", "replace"))
+    if match is None:
+        return 0  # java is there but we can't tell which one
+    major = int(match[1])
+    if major == 1 and match[2]:
+        major = int(match[2])  # 1.8 -> 8
+    return major
+
+
+# archives of the classes loaded by a server jar, which spare the JVM most
+# of its class loading and verification on the next start
+def class_data_sharing_flags(server_jar, java_version):
+    if not java_version or java_version < 13:
+        return []  # dynamic archives need JDK 13+
+    stat = os.stat(server_jar)
+    key = hashlib.sha1(
+        "{}\0{}\0{}".format(
+            os.path.abspath(server_jar), stat.st_mtime_ns, stat.st_size
+        ).encode("utf-8")
+    ).hexdigest()[:12]
+    directory = os.path.join(cache_dir(), "cds")
+    os.makedirs(directory, exist_ok=True)
+    archive = os.path.join(
+        directory,
+        "{}-{}-java{}.jsa".format(
+            os.path.splitext(os.path.basename(server_jar))[0], key, java_version
+        ),
+    )
+    if java_version >= 19:
+        return ["-XX:+AutoCreateSharedArchive", "-XX:SharedArchiveFile=" + archive]
+    if os.path.exists(archive):
+        return ["-XX:SharedArchiveFile=" + archive]
+    return ["-XX:ArchiveClassesAtExit=" + archive]
+
+
+def glob_to_regex(pattern):
+    i = 0
+    regex = ""
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                regex += "\\["
+            else:
+                regex += "[" + pattern[i + 1 : end].replace("!", "^", 1) + "]"
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex + "$")
+
+
+class GitIgnore(object):
+    def __init__(self, directory, parent=None):
+        self.directory = directory
+        self.parent = parent
+        self.rules = []
+        try:
+            with open(os.path.join(directory, ".gitignore")) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            lines = []
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            # patterns without an inner slash match at any depth
+            anchored = "/" in line
+            self.rules.append(
+                (glob_to_regex(line.lstrip("/")), negate, dir_only, anchored)
+            )
+
+    def ignored(self, path, is_dir):
+        ignored = self.parent is not None and self.parent.ignored(path, is_dir)
+        if not self.rules:
+            return ignored
+        relpath = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        name = relpath.rsplit("/", 1)[-1]
+        for regex, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath if anchored else name):
+                ignored = not negate
+        return ignored
+
+
+def iter_project_sources(source_roots, skip_nested_projects=False):
+    for source_root in source_roots:
+        # a trailing separator would keep the ignores of the root from being
+        # found as the parent of its subdirectories
+        source_root = os.path.normpath(source_root)
+        ignores = {}
+        for dirpath, dirnames, filenames in os.walk(source_root):
+            if (
+                skip_nested_projects
+                and PROJECT_FILE in filenames
+                and dirpath != source_root
+            ):
+                dirnames[:] = []  # belongs to the server of another project
+                continue
+            parent = ignores.get(os.path.dirname(dirpath))
+            if ".gitignore" in filenames:
+                ignore = GitIgnore(dirpath, parent)
+            else:
+                ignore = parent
+            ignores[dirpath] = ignore
+            dirnames[:] = [
+                d
+                for d in dirnames
+                if d not in SKIPPED_DIRECTORIES
+                and not (
+                    ignore is not None
+                    and ignore.ignored(os.path.join(dirpath, d), True)
+                )
+            ]
+            for filename in filenames:
+                if not filename.endswith(SOURCE_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if ignore is None or not ignore.ignored(path, False):
+                    yield path
+
+
+def load_json_file(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def extract_symbols(text):
+    # definitions at the top level or directly inside a top-level template
+    symbols = []
+    depth = 0
+    in_comment = False
+    package = ""
+    container = ""
+    for lnum, line in enumerate(text.splitlines(), 1):
+        if in_comment:
+            end = line.find("*/")
+            if end < 0:
+                continue
+            line = line[end + 2 :]
+            in_comment = False
+        code = LITERAL_PATTERN.sub("", line)
+        while "/*" in code:
+            start = code.index("/*")
+            end = code.find("*/", start + 2)
+            if end < 0:
+                code = code[:start]
+                in_comment = True
+            else:
+                code = code[:start] + code[end + 2 :]
+        if depth <= 1:
+            match = PACKAGE_PATTERN.match(code)
+            if match is not None:
+                name = match.group(2).replace("`", "")
+                if match.group(1):
+                    symbols.append((name, "object", lnum, match.start(2) + 1, package))
+                else:
+                    package = package + "." + name if package else name
+                    container = package
+                    symbols.append((package, "package", lnum, match.start(2) + 1, ""))
+            else:
+                match = SYMBOL_PATTERN.match(code)
+                if match is not None:
+                    kind, name = match.groups()
+                    name = name.strip("`")
+                    parent = package if depth == 0 else container
+                    symbols.append((name, kind, lnum, match.start(2) + 1, parent))
+                    if depth == 0 and kind in TYPE_KINDS:
+                        container = package + "." + name if package else name
+        depth = max(depth + code.count("{") - code.count("}"), 0)
+    return symbols
+
+
+class SymbolIndex(object):
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS symbols (
+                    name TEXT, kind TEXT, path TEXT,
+                    line INTEGER, col INTEGER, container TEXT
+                );
+                CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);
+                CREATE INDEX IF NOT EXISTS symbols_path ON symbols (path);
+                """
+            )
+
+    def update(self, source_roots):
+        with self.lock:
+            known = {
+                path: (mtime_ns, size)
+                for path, mtime_ns, size in self.db.execute(
+                    "SELECT path, mtime_ns, size FROM files"
+                )
+            }
+        seen = set()
+        changed = []
+        for path in iter_project_sources(source_roots):
+            seen.add(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) != (stat.st_mtime_ns, stat.st_size):
+                changed.append(path)
+        for i in range(0, len(changed), SYMBOL_INDEX_CHUNK):
+            self.index_files(changed[i : i + SYMBOL_INDEX_CHUNK])
+        removed = [path for path in known if path not in seen]
+        with self.lock, self.db:
+            self.db.executemany(
+                "DELETE FROM symbols WHERE path = ?", [(p,) for p in removed]
+            )
+            self.db.executemany(
+                "DELETE FROM files WHERE path = ?", [(p,) for p in removed]
+            )
+        return len(changed), len(removed)
+
+    def index_files(self, paths):
+        files = []
+        symbols = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+            except OSError:
+                continue
+            files.append((path, stat.st_mtime_ns, stat.st_size))
+            symbols.extend(
+                (name, kind, path, lnum, col, container)
+                for name, kind, lnum, col, container in extract_symbols(text)
+            )
+        with self.lock, self.db:
+            self.db.executemany(
+                "DELETE FROM symbols WHERE path = ?", [(f[0],) for f in files]
+            )
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", files)
+            self.db.executemany(
+                "INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?)", symbols
+            )
+
+    def search(self, query, limit):
+        # LIKE narrows the candidates down to case-insensitive subsequence
+        # matches before the fuzzy ranking
+        escaped = [c if c not in "%_\\" else "\\" + c for c in query]
+        pattern = "%" + "%".join(escaped) + "%"
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, kind, path, line, col, container FROM symbols"
+                " WHERE name LIKE ? ESCAPE '\\'",
+                (pattern,),
+            ).fetchall()
+        scored = []
+        for i, row in enumerate(rows):
+            score = fuzzy_score(query, row[0])
+            if score is not None:
+                scored.append((-score, len(row[0]), i, row))
+        return [entry[3] for entry in heapq.nsmallest(limit, scored)]
+
+    def lookup(self, name):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, kind, path, line, col, container FROM symbols"
+                " WHERE name = ?",
+                (name,),
+            ).fetchall()
+        # prefer types over terms of the same name
+        return sorted(rows, key=lambda row: row[1] not in TYPE_KINDS)
+
+
+def runtime_dir():
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base:
+        return os.path.join(base, "scalavista")
+    return os.path.join(tempfile.gettempdir(), "scalavista-{}".format(os.getuid()))
+
+
+# the registry tells editors where to send their sources, so it must not live
+# in a directory (such as a pre-created one in /tmp) that others can write to
+def runtime_dir_is_private():
+    directory = runtime_dir()
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(info.st_mode)
+        and info.st_uid == os.getuid()
+        and stat.S_IMODE(info.st_mode) & 0o077 == 0
+    )
 
-def get_offset_from_cursor(buf, cursor):
-    line = cursor[0]
-    col = cursor[1]
-    offset = 0
-    for i in range(line - 1):
-        offset += len(buf[i]) + 1
-    offset += col
-    return offset
 
+# shared servers are registered per (project root, Scala version) so that
+# several editors working on the same project can reuse one JVM
+class ServerRegistry(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+
+    @classmethod
+    def for_project(cls, root, scala_version):
+        key = hashlib.sha1(
+            "{}\0{}".format(root, scala_version).encode("utf-8")
+        ).hexdigest()[:16]
+        directory = runtime_dir()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        return cls(os.path.join(directory, "server-{}.json".format(key)))
+
+    @classmethod
+    def all(cls):
+        directory = runtime_dir()
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        return [
+            cls(os.path.join(directory, name))
+            for name in names
+            if name.startswith("server-") and name.endswith(".json")
+        ]
 
-# used to download server jars
-def download_file(url, file_name):
-    with open(file_name, "wb") as file:
-        response = requests.get(url)
-        file.write(response.content)
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self.read()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, entry):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def live_clients(entry):
+    return [
+        pid
+        for pid in entry.get("clients", [])
+        if pid != os.getpid() and pid_is_alive(pid)
+    ]
+
+
+# an editor that crashes or is killed never detaches from its shared server;
+# once no client is left alive the server is stopped by whichever editor
+# comes by next - runs on its own thread
+def reap_orphaned_servers():
+    for registry in ServerRegistry.all():
+        with registry.locked() as entry:
+            if entry is None:
+                continue
+            if not pid_is_alive(entry["pid"]):
+                registry.remove()
+            elif not any(pid_is_alive(pid) for pid in entry.get("clients", [])):
+                try:
+                    os.kill(entry["pid"], signal.SIGTERM)
+                except OSError:
+                    pass
+                registry.remove()
+
+
+# ports are picked at random, so make sure nothing is listening there already
+def find_free_port():
+    for _ in range(100):
+        port = random.randint(MIN_PORT, MAX_PORT)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.bind(("localhost", port))
+            except OSError:
+                continue
+        return port
+    return random.randint(MIN_PORT, MAX_PORT)
+
+
+def find_project_root(directory):
+    while True:
+        if os.path.isfile(os.path.join(directory, PROJECT_FILE)):
+            return directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def project_source_roots(root, config):
+    return [
+        os.path.normpath(os.path.join(root, directory))
+        for directory in config.get("sourceDirectories", [""])
+    ]
+
+
+# everything that belongs to one server: buffers are routed to the project of
+# their nearest scalavista.json, and projects of the same root and Scala
+# version share a server
+class Project(object):
+    def __init__(self, root, config, scala_version, stats):
+        self.root = root
+        self.config = config
+        self.scala_version = scala_version
+        self.key = (root, scala_version)
+        # False for the workspace fallback of files outside of any project
+        self.has_project_file = os.path.isfile(os.path.join(root, PROJECT_FILE))
+        self.port = random.randint(MIN_PORT, MAX_PORT)
+        self.uuid = uuid.uuid4().hex
+        self.client = ServerClient(self.server_url(), stats)
+        self.job = None
+        self.alive = False
+        self.starting = False
+        self.try_to_start = True
+        self.registry = None
+        self.capabilities = set()
+        self.push_mode = False
+        self.refresh_pending = False
+        # (ETag, raw body) of the last /errors response that was rendered
+        self.errors_validator = (None, None)
+        self.diagnostics = []
+        self.launch_time = None
+        self.awaiting_first_diagnostics = False
+        self.preload_cancel = None
+        self.partial_output = {}
+        self.suspended = False
+        # crash supervision
+        self.failures = 0
+        self.restart_at = 0.0
+        self.alive_since = None
+        self.last_used = time.monotonic()
+
+    def server_url(self):
+        return "http://localhost:{}".format(self.port)
+
+    def set_port(self, port):
+        self.port = port
+        self.client.base_url = self.server_url()
+
+    def instance_id(self):
+        return "{}@{}".format(self.uuid, self.port)
+
+    def source_roots(self):
+        return project_source_roots(self.root, self.config)
+
+    def running(self):
+        return self.alive or self.starting
+
+    def describe(self):
+        return "{} (Scala {})".format(self.root, self.scala_version)
+
+
+class LRUCache(object):
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if time.monotonic() > expires:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def completion_item(word, menu, kind):
+    kind_abbr = "v"
+    if kind == "method":
+        kind_abbr = "f"
+    elif kind in ["class", "trait", "object"]:
+        kind_abbr = "m"
+    return {"word": word, "menu": menu, "kind": kind_abbr, "dup": 1}
+
+
+def find_completion_start(line, col):
+    start = col
+    while start > 0 and line[start - 1] not in " .,([{":
+        start -= 1
+    return start
+
+
+def fuzzy_score(pattern, word):
+    lowered = word.lower()
+    score = 0
+    pos = 0
+    prev = -2
+    for ch in pattern.lower():
+        idx = lowered.find(ch, pos)
+        if idx < 0:
+            return None
+        if idx == 0:
+            score += 8
+        elif idx == prev + 1:
+            score += 5
+        elif word[idx].isupper() or word[idx - 1] in "_$":
+            score += 4  # start of a camelCase or snake_case segment
+        else:
+            score -= min(idx - pos, 3)
+        prev = idx
+        pos = idx + 1
+    if word.startswith(pattern):
+        score += 10
+    return score
+
+
+def rank_completions(base, items, limit):
+    if not base:
+        return items[:limit]
+    scored = []
+    for i, item in enumerate(items):
+        score = fuzzy_score(base, item["word"])
+        if score is not None:
+            scored.append((-score, len(item["word"]), i, item))
+    return [entry[3] for entry in heapq.nsmallest(limit, scored)]
+
+
+def check_artifact(path, actual, digest):
+    if digest and actual != digest:
+        os.remove(path)
+        raise RuntimeError(
+            "checksum mismatch for {}: expected {}, got {}".format(
+                os.path.basename(path), digest, actual
+            )
+        )
+    if not zipfile.is_zipfile(path):
+        os.remove(path)
+        raise RuntimeError("{} is not a jar".format(os.path.basename(path)))
+    return actual
+
+
+# used to download server jars - streams into '<file_name>.part', resumes an
+# interrupted download from where it stopped and only renames the result into
+# place once it is complete and matches the expected SHA-256 (if known)
+def download_file(url, file_name, digest=None):
+    partial = file_name + ".part"
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(partial, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                size += len(chunk)
+    except FileNotFoundError:
+        pass
+    headers = {"Range": "bytes={}-".format(size)} if size else {}
+    with requests.get(
+        url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        if response.status_code == 416:
+            expected = size  # nothing left to fetch - the .part is complete
+        else:
+            response.raise_for_status()
+            if response.status_code != 206:  # range ignored - start over
+                sha256 = hashlib.sha256()
+                size = 0
+            length = response.headers.get("Content-Length")
+            encoded = "Content-Encoding" in response.headers
+            expected = size + int(length) if length and not encoded else None
+            with open(partial, "ab" if size else "wb") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+    if expected is not None and size != expected:
+        # keep the .part around so that the next attempt resumes
+        raise RuntimeError(
+            "download of {} stopped after {} of {} bytes".format(url, size, expected)
+        )
+    check_artifact(partial, sha256.hexdigest(), digest)
+    os.replace(partial, file_name)
+    return sha256.hexdigest()
+
+
+def copy_file(source, file_name, digest=None):
+    sha256 = hashlib.sha256()
+    tmp_path = "{}.{}.tmp".format(file_name, os.getpid())
+    with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(DOWNLOAD_CHUNK_SIZE), b""):
+            dst.write(chunk)
+            sha256.update(chunk)
+    check_artifact(tmp_path, sha256.hexdigest(), digest)
+    os.replace(tmp_path, file_name)
+    return sha256.hexdigest()
+
+
+# puts a jar where the server jar discovery will find it; a hard link to the
+# cached copy when possible, so that several installs share the bytes
+def install_file(source, target):
+    tmp_path = os.path.join(
+        os.path.dirname(target),
+        ".{}.{}.tmp".format(os.path.basename(target), os.getpid()),
+    )
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+# server jars stored by their SHA-256 under '<root>/<sha256>/<name>', shared by
+# all plugin installs of a user; a mirror directory (e.g. a network share) is
+# consulted before GitHub, and a pre-seeded cache makes offline installs work
+class ArtifactCache(object):
+    def __init__(self, root, mirror=None):
+        self.root = root
+        self.mirror = mirror
+
+    def entries(self):
+        try:
+            digests = os.listdir(self.root)
+        except OSError:
+            return []
+        return [d for d in digests if DIGEST_PATTERN.fullmatch(d)]
+
+    def find(self, name, digest=None):
+        for d in [digest] if digest else self.entries():
+            path = os.path.join(self.root, d, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def jars(self):
+        jars = []
+        for d in self.entries():
+            directory = os.path.join(self.root, d)
+            jars.extend(
+                os.path.join(directory, f)
+                for f in os.listdir(directory)
+                if is_valid_server_jar(f)
+            )
+        return jars
+
+    @contextlib.contextmanager
+    def locked(self, name):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, "partial", name + ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # returns the cached path of the jar and whether it had to be fetched
+    def fetch(self, name, url, digest=None):
+        cached = self.find(name, digest)
+        if cached is not None:
+            return cached, False
+        os.makedirs(os.path.join(self.root, "partial"), exist_ok=True)
+        with self.locked(name):
+            cached = self.find(name, digest)  # another editor may have won
+            if cached is not None:
+                return cached, False
+            partial = os.path.join(self.root, "partial", name)
+            mirrored = os.path.join(self.mirror, name) if self.mirror else None
+            if mirrored is not None and os.path.isfile(mirrored):
+                actual = copy_file(mirrored, partial, digest)
+            else:
+                actual = download_file(url, partial, digest)
+            directory = os.path.join(self.root, actual)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, name)
+            os.replace(partial, path)
+            return path, True
 
 
 def is_valid_server_jar(jar):
-    scalavista_version_pattern = re.compile(r"\d+\.\d+\.\d+")
-    scala_version_pattern = re.compile(r"_\d\.\d{1,2}\.jar")
-    overall_pattern = re.compile(r"scalavista-server-.*\.jar")
     return (
-        scala_version_pattern.search(jar) is not None
-        and scalavista_version_pattern.search(jar) is not None
-        and overall_pattern.search(jar) is not None
+        jar.endswith(".jar")
+        and SCALA_VERSION_PATTERN.search(jar) is not None
+        and SCALAVISTA_VERSION_PATTERN.search(jar) is not None
+        and SERVER_JAR_PATTERN.search(jar) is not None
     )
 
 
 def get_scala_version_from_server_jar(jar):
-    scala_version_pattern = re.compile(r"_(\d\.\d{1,2})\.jar")
-    return scala_version_pattern.search(jar)[1]
+    return SCALA_VERSION_PATTERN.search(jar)[1]
 
 
 def get_scalavista_version_from_server_jar(jar):
-    scalavista_version_pattern = re.compile(r"\d+\.\d+\.\d+")
-    return scalavista_version_pattern.search(jar)[0]
-
-
-def get_latest_server_version(self):
-    releases = requests.get(
-        "https://api.github.com/repos/buntec/scalavista-server/releases"
-    ).json()
-    return releases[0]["tag_name"][1:]
+    return SCALAVISTA_VERSION_PATTERN.search(jar)[0]
 
 
-def get_urls_of_latest_server_jars():
-    releases = requests.get(
-        "https://api.github.com/repos/buntec/scalavista-server/releases"
-    ).json()
+def fetch_latest_release():
+    releases = requests.get(RELEASES_URL, timeout=UPDATE_CHECK_TIMEOUT).json()
     jars = {}
+    digests = {}
+    checksum_urls = {}
     for asset in releases[0]["assets"]:
         name = asset["name"]
         if is_valid_server_jar(name):
             jars[name] = asset["browser_download_url"]
-    return jars
+            digest = asset.get("digest") or ""
+            if digest.startswith("sha256:"):
+                digests[name] = digest[len("sha256:"):]
+        elif name.endswith(".sha256"):
+            checksum_urls[name[: -len(".sha256")]] = asset["browser_download_url"]
+    # older releases only publish '<jar>.sha256' files next to the jars
+    for name, url in checksum_urls.items():
+        if name in jars and name not in digests:
+            try:
+                match = DIGEST_PATTERN.search(
+                    requests.get(url, timeout=UPDATE_CHECK_TIMEOUT).text.lower()
+                )
+            except requests.RequestException:
+                continue
+            if match is not None:
+                digests[name] = match[0]
+    return {
+        "version": releases[0]["tag_name"][1:],
+        "jars": jars,
+        "digests": digests,
+    }
+
+
+# the GitHub API is rate-limited and slow to fail when offline, so the latest
+# release is remembered for a while
+def latest_release(ttl, force=False):
+    path = os.path.join(cache_dir(), "latest-release.json")
+    cached = load_json_file(path, None)
+    if not force and cached is not None and time.time() - cached["checked"] < ttl:
+        return cached
+    try:
+        release = fetch_latest_release()
+    except (requests.RequestException, ValueError, LookupError):
+        if cached is None:
+            raise
+        return cached  # stale beats nothing
+    release["checked"] = time.time()
+    try:
+        save_json_file(path, release)
+    except OSError:
+        pass
+    return release
+
+
+def get_urls_of_latest_server_jars():
+    release = latest_release(0, force=True)
+    return release["jars"], release.get("digests", {})
+
+
+def latest_server_jars(server_jars):
+    server_jars_by_version = {}
+    for jar in server_jars:
+        version = get_scalavista_version_from_server_jar(jar)
+        if version not in server_jars_by_version:
+            server_jars_by_version[version] = [jar]
+        else:
+            server_jars_by_version[version].append(jar)
+    if not server_jars_by_version:
+        return {}
+    all_versions = [Version(v) for v in server_jars_by_version.keys()]
+    all_versions.sort()
+    latest_version = all_versions[-1]
+    latest_server_jars = server_jars_by_version[latest_version.public]
+    server_jars_by_scala_version = {}
+    for jar in latest_server_jars:
+        scala_version = get_scala_version_from_server_jar(jar)
+        server_jars_by_scala_version[scala_version] = jar
+    return server_jars_by_scala_version
+
+
+# server jars per directory, rescanned only when the directory's mtime moves
+# (adding, removing or renaming a jar bumps it) or after a download
+class JarRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = {}  # path -> (mtime, jars)
+        self.key = None
+        self.jars = {}
+
+    def scan(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None, []
+        cached = self.directories.get(path)
+        if cached is None or cached[0] != mtime:
+            try:
+                files = os.listdir(path)
+            except OSError:
+                files = []
+            jars = [os.path.join(path, f) for f in files if is_valid_server_jar(f)]
+            cached = self.directories[path] = (mtime, jars)
+        return cached
+
+    def locate(self, search_paths):
+        with self.lock:
+            scans = [(path,) + self.scan(path) for path in search_paths]
+            key = tuple((path, mtime) for path, mtime, _ in scans)
+            if key != self.key:
+                self.key = key
+                self.jars = latest_server_jars(
+                    [jar for _, _, jars in scans for jar in jars]
+                )
+            return dict(self.jars)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.directories.pop(path, None)
+            self.key = None
+
+
+def server_jars_are_up_to_date(local_jars, latest_jars, scala_version):
+    if scala_version not in local_jars:
+        return False
+    local_version = Version(
+        get_scalavista_version_from_server_jar(local_jars[scala_version])
+    )
+    for jar in latest_jars:
+        if get_scala_version_from_server_jar(jar) == scala_version:
+            latest_version = Version(get_scalavista_version_from_server_jar(jar))
+            if local_version < latest_version:
+                return False
+    return True
 
 
 @pynvim.plugin
@@ -79,13 +1501,70 @@ class Scalavista(object):
     def __init__(self, nvim):
         self.nvim = nvim
         self.initialized = False
-        self.qflist = []
-        self.errors = ""
-        self.server_port = random.randint(MIN_PORT, MAX_PORT)
-        self.server_alive = False
-        self.try_to_start_server = True
-        self.uuid = uuid.uuid4().hex
-        self.notify_on_server_exit = True
+        self.unsupported = False
+        self.log = None
+        self.qflist_id = None
+        self.last_echoed = None
+        # the diagnostics of all projects, in project order; this doubles as
+        # the local copy of the quickfix list, of which the first
+        # qflist_filled entries have been handed to nvim so far
+        self.diagnostics = []
+        self.qflist_filled = 0
+        # path -> (sorted line numbers, diagnostics sorted by line)
+        self.diagnostics_by_path = {}
+        # path -> (bufnr, {diagnostic: sign id}) of what is currently drawn
+        self.rendered_diagnostics = {}
+        # with very many diagnostics only the visible ones are drawn at once
+        self.lazy_diagnostics = False
+        self.lazy_diagnostics_threshold = DEFAULT_LAZY_DIAGNOSTICS_THRESHOLD
+        self.fill_timer = None
+        self.last_sign_id = 0
+        self.stats = Stats()
+        # (root, Scala version) -> Project, least recently used first
+        self.projects = collections.OrderedDict()
+        # directory -> root of the project it belongs to (None if none)
+        self.project_roots = {}
+        # job id -> Project whose server the job runs
+        self.jobs = {}
+        self.max_servers = DEFAULT_MAX_SERVERS
+        self.server_idle_timeout = DEFAULT_SERVER_IDLE_TIMEOUT
+        self.refresh_timer = None
+        self.server_start_timer = None
+        self.server_start_due = 0.0
+        self.last_orphan_reap = 0.0
+        self.poll_interval_ms = MIN_POLL_INTERVAL_MS
+        self.poll_activity = False
+        self.max_poll_interval_ms = DEFAULT_MAX_POLL_INTERVAL_MS
+        self.errors_stale = False
+        self.completion_cache = None
+        self.async_completion = False
+        self.async_completion_cache = None
+        self.pending_completions = []
+        self.completion_callback = ""
+        self.hover_cache = LRUCache(DEFAULT_HOVER_CACHE_SIZE, DEFAULT_HOVER_CACHE_TTL)
+        self.pending_queries = {}
+        self.prefetch_type = False
+        self.max_completions = DEFAULT_MAX_COMPLETIONS
+        self.is_debug = False
+        self.shared_server = False
+        self.default_scala_version = "2.13"
+        self.workspace_root = None
+        # project root -> contents of its scalavista.json
+        self.project_configs = {}
+        self.java_version = None
+        self.jar_registry = JarRegistry()
+        self.server_jar_paths = []
+        self.server_jars = {}
+        self.update_check_ttl = DEFAULT_UPDATE_CHECK_TTL
+        self.ready_pattern = re.compile(DEFAULT_READY_PATTERN)
+        self.symbol_index_enabled = False
+        # project root -> its SymbolIndex (None if it could not be opened)
+        self.symbol_indexes = {}
+        self.preload_enabled = False
+        self.open_files = set()
+        self.sync_states = {}
+        self.sync_timer = None
+        self.last_edit_time = 0.0
 
     def get_global_var_or_else(self, var_name, default_value):
         full_var_name = "g:{}".format(var_name)
@@ -101,9 +1580,6 @@ class Scalavista(object):
                 return path
         raise RuntimeError("neovim-scalavista runtime path not found")
 
-    def server_url(self):
-        return "http://localhost:{}".format(self.server_port)
-
     @pynvim.command("ScalavistaCommands")
     def show_commands(self):
         def predicate(fn):
@@ -119,104 +1595,228 @@ class Scalavista(object):
     def print_server_jars(self):
         self.notify(self.locate_server_jars())
 
+    def server_jar_search_paths(self):
+        return ["."] + self.nvim.list_runtime_paths()
+
     def locate_server_jars(self):
-        runtime_paths = self.nvim.list_runtime_paths()
-        server_jars = []
-        for path in ["."] + runtime_paths:
-            if os.path.isdir(path):
-                for file in os.listdir(path):
-                    if is_valid_server_jar(file):
-                        server_jars.append(os.path.join(path, file))
-        server_jars_by_version = {}
-        for jar in server_jars:
-            version = get_scalavista_version_from_server_jar(jar)
-            if version not in server_jars_by_version:
-                server_jars_by_version[version] = [jar]
-            else:
-                server_jars_by_version[version].append(jar)
-        if not server_jars_by_version:
-            return {}
-        all_versions = [Version(v) for v in server_jars_by_version.keys()]
-        all_versions.sort()
-        latest_version = all_versions[-1]
-        latest_server_jars = server_jars_by_version[latest_version.public]
-        server_jars_by_scala_version = {}
-        for jar in latest_server_jars:
-            scala_version = get_scala_version_from_server_jar(jar)
-            server_jars_by_scala_version[scala_version] = jar
-        return server_jars_by_scala_version
-
-    def suitable_server_jar_available(self):
-        local_jars = self.locate_server_jars()
-        return self.scala_version in local_jars
-
-    def server_jars_are_up_to_date(self):
-        latest_jars = get_urls_of_latest_server_jars()
-        local_jars = self.locate_server_jars()
-        if self.scala_version not in local_jars:
-            return False
-        local_version = Version(
-            get_scalavista_version_from_server_jar(local_jars[self.scala_version])
+        return self.jar_registry.locate(self.server_jar_search_paths())
+
+    # jar discovery, the java check and the update check all hit the disk,
+    # subprocesses or the network, so they stay off the BufEnter path
+    def discover_server(self, check_for_updates=True):
+        threading.Thread(
+            target=self.run_server_discovery,
+            args=(
+                self.server_jar_search_paths(),
+                self.update_check_ttl if check_for_updates else -1,
+            ),
+            daemon=True,
+        ).start()
+
+    # runs on its own thread - must not touch self.nvim
+    def run_server_discovery(self, search_paths, update_check_ttl):
+        java_version = detect_java_version()
+        jars = self.jar_registry.locate(search_paths)
+        self.nvim.async_call(
+            self.on_server_discovered, java_version, search_paths, jars
+        )
+        if update_check_ttl < 0:
+            return
+        try:
+            release = latest_release(update_check_ttl)
+        except Exception:
+            return  # offline - not worth bothering the user about
+        self.nvim.async_call(
+            self.on_update_checked,
+            bool(jars)
+            and all(
+                server_jars_are_up_to_date(jars, release["jars"], scala_version)
+                for scala_version in jars
+            ),
         )
-        for jar in latest_jars:
-            if get_scala_version_from_server_jar(jar) == self.scala_version:
-                latest_version = Version(get_scalavista_version_from_server_jar(jar))
-                if local_version < latest_version:
-                    return False
-        return True
 
-    def check_server_jars_and_prompt_for_download(self):
-        if not self.server_jars_are_up_to_date():
-            response = self.nvim.call(
-                "input",
-                "scalavista[info]> you don't have the latest server jar - download from GitHub (y/n)?",
+    def on_server_discovered(self, java_version, search_paths, jars):
+        self.java_version = java_version
+        self.server_jar_paths = search_paths
+        self.server_jars = jars
+        if java_version is None:
+            self.error(
+                "unable to start server because no 'java' executable was found on your PATH"
             )
-            if response.lower() == "y":
-                self.download_server_jars(self.scala_version)
-        else:
+            return
+        for project in self.projects.values():
+            if not project.running() and project.job is None:
+                project.try_to_start = True
+        self.schedule_server_start()
+
+    def on_update_checked(self, up_to_date):
+        if up_to_date:
             self.notify("server jars are up-to-date")
+        else:
+            self.notify(
+                "you don't have the latest server jar - download it from GitHub with :ScalavistaDownloadServerJars"
+            )
+
+    def project_config(self, root):
+        config = self.project_configs.get(root)
+        if config is None:
+            config = load_json_file(os.path.join(root, PROJECT_FILE), {})
+            if not isinstance(config, dict):
+                config = {}
+            self.project_configs[root] = config
+        return config
+
+    # the project of the nearest scalavista.json above the file, or the
+    # workspace (nvim's cwd) for files outside of any project
+    def project_for(self, filename):
+        if filename:
+            directory = os.path.dirname(os.path.abspath(filename))
+        else:
+            directory = self.workspace_root  # an unnamed buffer
+        if directory not in self.project_roots:
+            self.project_roots[directory] = find_project_root(directory)
+        root = self.project_roots[directory] or self.workspace_root
+        config = self.project_config(root)
+        scala_version = config.get("scalaBinaryVersion", self.default_scala_version)
+        project = self.projects.get((root, scala_version))
+        if project is None:
+            project = Project(root, config, scala_version, self.stats)
+            self.projects[project.key] = project
+            if "scalaBinaryVersion" in config:
+                self.notify(
+                    "scalavista.json found - the Scala binary version for {} is {}".format(
+                        root, scala_version
+                    )
+                )
+            else:
+                self.notify(
+                    "scalavista.json not found - defaulting to Scala {} for {}".format(
+                        scala_version, root
+                    )
+                )
+        return project
+
+    # commands may be run from any buffer, but only Scala and Java sources
+    # are attached and synced; None if the plugin cannot run at all
+    def current_project(self):
+        # commands may also be run before the first Scala buffer is entered
+        if not self.initialize():
+            return None
+        filename = self.nvim.call("expand", "%:p")
+        if filename.endswith(SOURCE_EXTENSIONS):
+            state = self.attach_buffer(self.nvim.current.buffer.number)
+            if state is not None:
+                return state.project
+        return self.project_for(filename)
+
+    def touch(self, project):
+        project.last_used = time.monotonic()
+        self.projects.move_to_end(project.key)
+
+    def activate_project(self, project):
+        self.touch(project)
+        if project.suspended:
+            project.suspended = False
+            project.try_to_start = True
+        if project.try_to_start and not project.running():
+            self.schedule_server_start()
+
+    @pynvim.command("ScalavistaServers")
+    def show_servers(self):
+        for project in self.projects.values():
+            if project.alive:
+                status = "live at {}".format(project.server_url())
+            elif project.starting:
+                status = "starting"
+            elif project.suspended:
+                status = "stopped (idle)"
+            else:
+                status = "not running"
+            self.notify("{}: {}".format(project.describe(), status))
 
     def initialize(self):
+        if self.unsupported:
+            return False
         if not self.initialized:
-            self.log_file = open("scalavista.log", "w", buffering=1)
-            self.scala_version = self.get_global_var_or_else(
+            if not self.nvim.call("has", MIN_NVIM_VERSION):
+                self.unsupported = True
+                self.error("neovim-scalavista requires Neovim 0.5 or later")
+                return False
+            log_file = self.get_global_var_or_else(
+                "scalavista_log_file", os.path.join(cache_dir(), "scalavista.log")
+            )
+            # relative names are taken relative to the directory nvim was
+            # started in, which the plugin host keeps as its own cwd
+            self.log = LogWriter(
+                os.path.abspath(os.path.expanduser(log_file)),
+                self.get_global_var_or_else(
+                    "scalavista_log_max_bytes", DEFAULT_LOG_MAX_BYTES
+                ),
+            )
+            self.log.write(
+                "--- neovim-scalavista (pid {}) started {}\n".format(
+                    os.getpid(), time.strftime("%Y-%m-%d %H:%M:%S")
+                )
+            )
+            self.default_scala_version = self.get_global_var_or_else(
                 "scalavista_default_scala_version", "2.13"
             )
             if self.get_global_var_or_else("scalavista_debug_mode", 0) != 0:
                 self.is_debug = True
             else:
                 self.is_debug = False
+            self.sync_debounce_ms = self.get_global_var_or_else(
+                "scalavista_sync_debounce_ms", DEFAULT_SYNC_DEBOUNCE_MS
+            )
+            self.async_completion = (
+                self.get_global_var_or_else("scalavista_async_completion", 0) != 0
+            )
+            self.completion_callback = self.get_global_var_or_else(
+                "scalavista_completion_callback", ""
+            )
+            self.max_completions = self.get_global_var_or_else(
+                "scalavista_max_completions", DEFAULT_MAX_COMPLETIONS
+            )
+            self.hover_cache = LRUCache(
+                self.get_global_var_or_else(
+                    "scalavista_hover_cache_size", DEFAULT_HOVER_CACHE_SIZE
+                ),
+                self.get_global_var_or_else(
+                    "scalavista_hover_cache_ttl", DEFAULT_HOVER_CACHE_TTL
+                ),
+            )
+            self.prefetch_type = (
+                self.get_global_var_or_else("scalavista_prefetch_type", 0) != 0
+            )
 
-            try:
-                cwd = self.nvim.call("getcwd")
-                path_to_try = os.path.join(cwd, "scalavista.json")
-                with open(path_to_try) as f:
-                    self.scala_version = json.load(f)["scalaBinaryVersion"]
-                    self.notify(
-                        "scalavista.json found - the Scala binary version for this project is {}".format(
-                            self.scala_version
-                        )
-                    )
-            except Exception:
-                self.notify(
-                    "scalavista.json not found - defaulting to Scala {}".format(
-                        self.scala_version
+            self.shared_server = (
+                self.get_global_var_or_else("scalavista_shared_server", 0) != 0
+            )
+            if self.shared_server and fcntl is None:
+                self.shared_server = False
+                self.warn("shared servers are not supported on this platform")
+            if self.shared_server and not runtime_dir_is_private():
+                self.shared_server = False
+                self.warn(
+                    "shared servers disabled: {} must be a directory owned by you with mode 0700".format(
+                        runtime_dir()
                     )
                 )
-                pass
-
-            self.check_server_jars_and_prompt_for_download()
 
-            if not self.suitable_server_jar_available():
-                self.error(
-                    "unable to start server because no suitable server jar was found - try :ScalavistaDownloadServerJars"
-                )
+            self.workspace_root = self.nvim.call("getcwd")
+            self.max_servers = max(
+                1,
+                self.get_global_var_or_else(
+                    "scalavista_max_servers", DEFAULT_MAX_SERVERS
+                ),
+            )
+            self.server_idle_timeout = self.get_global_var_or_else(
+                "scalavista_server_idle_timeout", DEFAULT_SERVER_IDLE_TIMEOUT
+            )
 
-            if not self.java_is_available():
-                self.try_to_start_server = False
-                self.error(
-                    "unable to start server because no 'java' executable was found on your PATH"
-                )
+            self.update_check_ttl = self.get_global_var_or_else(
+                "scalavista_update_check_ttl", DEFAULT_UPDATE_CHECK_TTL
+            )
 
             self.nvim.command("highlight link ScalavistaUnderlineStyle SpellBad")
             self.nvim.command(
@@ -226,6 +1826,7 @@ class Scalavista(object):
                 "highlight ScalavistaWarningStyle ctermfg=9 ctermbg=0 guifg=#F99157 guibg=#1B2B34"
             )
             self.nvim.command("set omnifunc=ScalavistaCompleteFunc")
+            self.namespace = self.nvim.api.create_namespace("scalavista")
             # self.nvim.command('set completeopt=longest,menuone')  # better let the user set this
             self.error_sign = "ScalavistaErrorSign"
             self.warning_sign = "ScalavistaWarningSign"
@@ -241,14 +1842,31 @@ class Scalavista(object):
                 )
             )
             self.nvim.command("sign define {} text=>".format(self.info_sign))
-            self.refresh_timer = self.nvim.call(
-                "timer_start", 500, "ScalavistaRefresh", {"repeat": -1}
+            self.max_poll_interval_ms = self.get_global_var_or_else(
+                "scalavista_max_poll_interval_ms", DEFAULT_MAX_POLL_INTERVAL_MS
             )
-            self.server_start_timer = self.nvim.call(
-                "timer_start", 500, "ScalavistaConditionallyStartServer", {"repeat": -1}
+            self.lazy_diagnostics_threshold = self.get_global_var_or_else(
+                "scalavista_lazy_diagnostics_threshold",
+                DEFAULT_LAZY_DIAGNOSTICS_THRESHOLD,
+            )
+            self.symbol_index_enabled = (
+                self.get_global_var_or_else("scalavista_symbol_index", 1) != 0
+            )
+            trace_file = self.get_global_var_or_else("scalavista_trace_file", "")
+            if trace_file:
+                self.stats.start_trace(os.path.expanduser(trace_file))
+            self.preload_enabled = (
+                self.get_global_var_or_else("scalavista_preload", 1) != 0
+            )
+            self.ready_pattern = re.compile(
+                self.get_global_var_or_else(
+                    "scalavista_ready_pattern", DEFAULT_READY_PATTERN
+                )
             )
             self.initialized = True
-            self.check_health()
+            self.discover_server()
+            self.schedule_refresh(0)
+        return True
 
     def notify(self, msg):
         self.nvim.out_write("scalavista[info]> {}\n".format(msg))
@@ -263,237 +1881,1522 @@ class Scalavista(object):
     def download_server_jars_for_all_scala_versions(self):
         self.download_server_jars()
 
+    # downloads are streamed on their own thread so that a slow connection
+    # doesn't freeze the editor
     def download_server_jars(self, scala_version=None):
+        cache = ArtifactCache(
+            os.path.expanduser(
+                self.get_global_var_or_else(
+                    "scalavista_artifact_cache", os.path.join(cache_dir(), "jars")
+                )
+            ),
+            os.path.expanduser(
+                self.get_global_var_or_else("scalavista_artifact_mirror", "")
+            )
+            or None,
+        )
+        threading.Thread(
+            target=self.run_server_jar_download,
+            args=(cache, self.get_plugin_path(), scala_version),
+            daemon=True,
+        ).start()
+
+    # runs on its own thread - must not touch self.nvim except via async_call
+    def run_server_jar_download(self, cache, plugin_path, scala_version):
+        def notify(msg):
+            self.nvim.async_call(self.notify, msg)
+
         try:
-            jars = get_urls_of_latest_server_jars()
-            for jar, download_url in jars.items():
-                if (
-                    scala_version is not None
-                    and get_scala_version_from_server_jar(jar) != scala_version
-                ):
-                    continue
-                self.notify("attempting to download {} ...".format(download_url))
-                write_path = os.path.join(self.get_plugin_path(), jar)
-                download_file(download_url, write_path)
-                self.notify("successfully downloaded {} to {}".format(jar, write_path))
+            jars, digests = get_urls_of_latest_server_jars()
         except Exception:
-            self.error(
-                "failed to download server jar(s) - no internet or behind proxy?"
-            )
-
-    def java_is_available(self):
-        jobid = self.nvim.call("jobstart", ["java", "-version"])
-        return jobid > 0
-
-    def start_server(self, server_jar):
-        flags = [
-            "java",
-            "-jar",
-            server_jar,
-            "--uuid",
-            self.uuid,
-            "--port",
-            self.server_port,
-        ]
+            # offline and no release cached - install what the cache holds
+            jars = {
+                os.path.basename(path): None
+                for path in latest_server_jars(cache.jars()).values()
+            }
+            digests = {}
+            if not jars:
+                self.nvim.async_call(
+                    self.error,
+                    "failed to download server jar(s) - no internet or behind proxy?",
+                )
+                return
+            notify(
+                "GitHub is unreachable - installing server jars from {}".format(
+                    cache.root
+                )
+            )
+        failed = False
+        for jar, download_url in jars.items():
+            if (
+                scala_version is not None
+                and get_scala_version_from_server_jar(jar) != scala_version
+            ):
+                continue
+            write_path = os.path.join(plugin_path, jar)
+            try:
+                if download_url is None:
+                    cached, fetched = cache.find(jar), False
+                else:
+                    if cache.find(jar, digests.get(jar)) is None:
+                        notify("attempting to download {} ...".format(download_url))
+                    cached, fetched = cache.fetch(jar, download_url, digests.get(jar))
+                install_file(cached, write_path)
+            except Exception as e:
+                failed = True
+                self.nvim.async_call(
+                    self.error, "failed to download {}: {}".format(jar, e)
+                )
+                continue
+            self.jar_registry.invalidate(plugin_path)
+            notify(
+                "successfully {} {} to {}".format(
+                    "downloaded" if fetched else "installed cached", jar, write_path
+                )
+            )
+        if failed:
+            notify("run :ScalavistaDownloadServerJars again to resume")
+        self.nvim.async_call(self.on_server_jars_downloaded)
+
+    def on_server_jars_downloaded(self):
+        if self.initialized:
+            self.discover_server(check_for_updates=False)
+
+    def jvm_flags(self, project, server_jar):
+        flags = list(project.config.get("jvmOptions", []))
+        flags.extend(self.get_global_var_or_else("scalavista_jvm_options", []))
+        if self.get_global_var_or_else("scalavista_class_data_sharing", 1) != 0:
+            try:
+                flags.extend(class_data_sharing_flags(server_jar, self.java_version))
+            except OSError as e:
+                self.warn("not using class data sharing: {}".format(e))
+        return flags
+
+    def start_server(self, project, server_jar, detach=False):
+        flags = (
+            ["java"]
+            + self.jvm_flags(project, server_jar)
+            + ["-jar", server_jar, "--uuid", project.uuid, "--port", project.port]
+        )
         if self.is_debug:
             flags.append("--debug")
-        self.try_to_start_server = False
-        self.server_job = self.nvim.call(
+        project.launch_time = time.monotonic()
+        project.awaiting_first_diagnostics = True
+        project.try_to_start = False
+        project.starting = True
+        # the server picks up the scalavista.json of its working directory
+        job = self.nvim.call(
             "jobstart",
             flags,
             {
                 "on_exit": "ScalavistaServerFailed",
                 "on_stdout": "ScalavistaWriteToLog",
                 "on_stderr": "ScalavistaWriteToLog",
+                "detach": detach,
+                "cwd": project.root,
             },
         )
-        if self.server_job > 0:
-            self.notify("starting scalavista server from {}".format(server_jar))
+        if job > 0:
+            project.job = job
+            self.jobs[job] = project
+            self.notify(
+                "starting scalavista server for {} from {}".format(
+                    project.describe(), server_jar
+                )
+            )
+            self.poke_refresh()
         else:
+            project.starting = False
             self.error("failed to start scalavista server from {}".format(server_jar))
 
     @pynvim.command("ScalavistaRestartServer")
-    def stop_server(self):
-        self.notify_on_server_exit = False
-        try:
-            self.nvim.call("chansend", self.server_job, ["x", ""])
-            self.nvim.call("jobstop", self.server_job)
-        except Exception:
-            pass
-        self.try_to_start_server = True
-        self.notify_on_server_exit = True
+    def restart_server(self):
+        project = self.current_project()
+        if project is None:
+            return
+        self.stop_server(project)
+        project.failures = 0
+        project.restart_at = 0.0
+        self.schedule_server_start()
+
+    def stop_server(self, project):
+        if project.registry is not None:
+            with project.registry.locked() as entry:
+                if entry is not None and entry["uuid"] == project.uuid:
+                    self.kill_shared_server(project, entry)
+        if project.job is not None:
+            # forgotten first, so that its exit is not reported as a failure
+            self.jobs.pop(project.job, None)
+            try:
+                self.nvim.call("chansend", project.job, ["x", ""])
+                self.nvim.call("jobstop", project.job)
+            except Exception:
+                pass
+            project.job = None
+        project.alive = False
+        project.starting = False
+        project.push_mode = False
+        self.cancel_preload(project)
+        project.try_to_start = True
+
+    # stops a server to free its JVM; it is started again once one of the
+    # project's buffers is entered
+    def suspend_server(self, project):
+        if project.registry is not None:
+            # other editors may still be using it
+            self.detach_shared_server(project)
+            project.registry = None
+            if project.job is not None:
+                self.jobs.pop(project.job, None)
+                project.job = None
+            project.alive = False
+            project.starting = False
+            project.push_mode = False
+            self.cancel_preload(project)
+        else:
+            self.stop_server(project)
+        project.try_to_start = False
+        project.suspended = True
+
+    def make_room_for(self, project):
+        running = [
+            other
+            for other in self.projects.values()
+            if other is not project and other.running()
+        ]
+        # least recently used first
+        for victim in running[: max(0, len(running) - self.max_servers + 1)]:
+            self.notify(
+                "stopping the least recently used server of {}".format(
+                    victim.describe()
+                )
+            )
+            self.suspend_server(victim)
+
+    def stop_idle_servers(self):
+        if self.server_idle_timeout <= 0:
+            return
+        now = time.monotonic()
+        for project in list(self.projects.values()):
+            if project.running() and now - project.last_used > self.server_idle_timeout:
+                self.notify("stopping idle server of {}".format(project.describe()))
+                self.suspend_server(project)
 
     @pynvim.function("ScalavistaServerFailed")
-    def resume_server_start(self, code):
-        if self.notify_on_server_exit:
+    def resume_server_start(self, args):
+        job, code = args[0], args[1]
+        project = self.jobs.pop(job, None)
+        if project is None:
+            return  # stopped on purpose
+        project.job = None
+        project.alive = False
+        project.starting = False
+        project.push_mode = False
+        self.cancel_preload(project)
+        now = time.monotonic()
+        if (
+            project.alive_since is not None
+            and now - project.alive_since > STABLE_SERVER_SECONDS
+        ):
+            project.failures = 0
+        project.alive_since = None
+        project.failures += 1
+        if project.failures > MAX_SERVER_RESTARTS:
             self.warn(
-                "scalavista server failed: inspect 'scalavista.log' or retry with :ScalavistaRestartServer".format(
-                    code
+                "scalavista server for {} failed {} times in a row: inspect '{}' or retry with :ScalavistaRestartServer".format(
+                    project.describe(), MAX_SERVER_RESTARTS, self.log.path
                 )
             )
+            return
+        delay = min(
+            RESTART_BACKOFF_BASE * 2 ** (project.failures - 1), RESTART_BACKOFF_MAX
+        )
+        project.restart_at = now + delay
+        project.try_to_start = True
+        self.warn(
+            "scalavista server for {} exited with code {} - restarting in {:.0f}s".format(
+                project.describe(), code, delay
+            )
+        )
+        self.schedule_server_start(int(delay * 1000))
 
     @pynvim.function("ScalavistaWriteToLog")
     def write_to_log(self, data):
-        self.log_file.write(str("\n".join(data[1])))
+        job, lines, stream = data
+        self.log.write("\n".join(lines))
+        project = self.jobs.get(job)
+        if project is None:
+            return
+        # job output arrives in arbitrary chunks - the last item is always
+        # the (possibly empty) start of an unfinished line
+        lines = list(lines)
+        lines[0] = project.partial_output.get(stream, "") + lines[0]
+        project.partial_output[stream] = lines.pop()
+        if stream != "stdout":
+            return
+        for line in lines:
+            if project.starting and self.ready_pattern.search(line):
+                self.schedule_refresh(0)
+            if line.startswith(EVENT_PREFIX):
+                try:
+                    event = json.loads(line[len(EVENT_PREFIX) :])
+                except ValueError:
+                    continue
+                self.handle_server_event(project, event)
+
+    def handle_server_event(self, project, event):
+        project.push_mode = True
+        if event.get("type") == "errors":
+            self.update_errors_and_populate_quickfix([project])
+        elif event.get("type") == "ready" and project.starting:
+            self.schedule_refresh(0)
+
+    def start_or_attach_shared_server(self, project, server_jar):
+        registry = ServerRegistry.for_project(project.root, project.scala_version)
+        project.registry = registry
+        with registry.locked() as entry:
+            if (
+                entry is not None
+                and pid_is_alive(entry["pid"])
+                and not live_clients(entry)
+                and os.getpid() not in entry.get("clients", [])
+            ):
+                # orphaned by editors that died without detaching
+                self.kill_shared_server(project, entry)
+                entry = None
+            if entry is not None and pid_is_alive(entry["pid"]):
+                project.set_port(entry["port"])
+                project.uuid = entry["uuid"]
+                project.try_to_start = False
+                entry["clients"] = live_clients(entry) + [os.getpid()]
+                registry.write(entry)
+                self.notify(
+                    "attaching to shared scalavista server at {}".format(
+                        project.server_url()
+                    )
+                )
+                self.poke_refresh()
+                return
+            project.set_port(find_free_port())
+            project.uuid = uuid.uuid4().hex
+            # detached so that the server outlives this editor if others use it
+            self.start_server(project, server_jar, detach=True)
+            if project.job is not None:
+                registry.write(
+                    {
+                        "port": project.port,
+                        "uuid": project.uuid,
+                        "pid": self.nvim.call("jobpid", project.job),
+                        "clients": [os.getpid()],
+                    }
+                )
+
+    def detach_shared_server(self, project):
+        with project.registry.locked() as entry:
+            if entry is None or entry["uuid"] != project.uuid:
+                return
+            entry["clients"] = live_clients(entry)
+            if entry["clients"]:
+                project.registry.write(entry)
+            else:
+                self.kill_shared_server(project, entry)
+
+    def kill_shared_server(self, project, entry):
+        try:
+            os.kill(entry["pid"], signal.SIGTERM)
+        except OSError:
+            pass
+        project.registry.remove()
+
+    def schedule_server_start(self, delay_ms=0):
+        due = time.monotonic() + delay_ms / 1000
+        if self.server_start_timer is not None:
+            if self.server_start_due <= due:
+                return
+            self.nvim.call("timer_stop", self.server_start_timer)
+        self.server_start_due = due
+        self.server_start_timer = self.nvim.call(
+            "timer_start", delay_ms, "ScalavistaConditionallyStartServer"
+        )
 
     @pynvim.function("ScalavistaConditionallyStartServer")
     def conditionally_start_server(self, timer):
-        if self.try_to_start_server and not self.server_alive:
-            scalavista_server_jars = self.locate_server_jars()
-            if self.scala_version in scalavista_server_jars:
-                server_jar = scalavista_server_jars[self.scala_version]
-                self.server_port = random.randint(MIN_PORT, MAX_PORT)
-                self.start_server(server_jar)
-
-    def check_health(self):
-        try:
-            res = requests.get(self.server_url() + "/alive")
-            if res.status_code == requests.codes.ok and res.text == self.uuid:
-                if not self.server_alive:
-                    version = self.get_server_version()
-                    self.notify(
-                        "scalavista server {} now live at {}".format(
-                            version, self.server_url()
-                        )
+        self.server_start_timer = None
+        if self.java_version is None:
+            return  # discovery is still running or found no java
+        # cheap unless a jar directory changed since the last tick
+        self.server_jars = self.jar_registry.locate(self.server_jar_paths)
+        now = time.monotonic()
+        next_restart = None
+        for project in list(self.projects.values()):
+            if not project.try_to_start or project.running():
+                continue
+            if project.restart_at > now:
+                # still backing off after a crash
+                if next_restart is None or project.restart_at < next_restart:
+                    next_restart = project.restart_at
+                continue
+            if project.scala_version not in self.server_jars:
+                project.try_to_start = False
+                self.error(
+                    "unable to start server for {} because no suitable server jar was found - try :ScalavistaDownloadServerJars".format(
+                        project.describe()
                     )
-                self.server_alive = True
-            else:
-                raise Exception("uuid mismatch or bad server response: {}".format(res))
+                )
+                continue
+            self.make_room_for(project)
+            server_jar = self.server_jars[project.scala_version]
+            if self.shared_server:
+                self.start_or_attach_shared_server(project, server_jar)
+                continue
+            project.set_port(find_free_port())
+            self.start_server(project, server_jar)
+        if next_restart is not None:
+            self.schedule_server_start(int((next_restart - now) * 1000) + 1)
+
+    def run_async(
+        self,
+        client,
+        fn,
+        callback,
+        errback=None,
+        *args,
+        priority=PRIORITY_QUERY,
+        key=None
+    ):
+        future = client.submit(fn, *args, priority=priority, key=key)
+
+        def done(future):
+            self.nvim.async_call(self.deliver_result, future, callback, errback)
+
+        future.add_done_callback(done)
+        return future
+
+    def deliver_result(self, future, callback, errback):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is None:
+            callback(future.result())
+        elif errback is not None:
+            errback(e)
+        elif self.is_debug:
+            self.error("request failed: {}".format(e))
+
+    # runs on a worker thread - must not touch self.nvim
+    def probe_health(self, project, was_alive):
+        try:
+            res = project.client.get("/alive")
         except Exception:
-            self.server_alive = False
+            return None
+        if res.status_code != requests.codes.ok:
+            return None
+        if project.client.text("/alive", res) != project.uuid:
+            return None
+        if was_alive:
+            return {}
+        return {
+            "version": self.fetch_server_version(project.client),
+            "capabilities": self.fetch_server_capabilities(project.client),
+        }
+
+    def apply_health(self, project, health):
+        if health is None:
+            if project.alive:
+                self.cancel_preload(project)
+            if project.alive and project.registry is not None:
+                # the shared server went away - attach to or start another one
+                project.try_to_start = True
+                self.schedule_server_start()
+            project.alive = False
+            return
+        if not project.alive:
+            startup = ""
+            if project.starting and project.launch_time is not None:
+                startup = " (started in {:.1f}s)".format(
+                    time.monotonic() - project.launch_time
+                )
+            self.notify(
+                "scalavista server {} for {} now live at {}{}".format(
+                    health.get("version", "?"),
+                    project.describe(),
+                    project.server_url(),
+                    startup,
+                )
+            )
+            project.capabilities = health.get("capabilities", set())
+            project.client.negotiate(project.capabilities)
+            project.alive = True
+            project.alive_since = time.monotonic()
+            project.starting = False
+            # events only reach the editor that launched the server
+            project.push_mode = (
+                project.job is not None and "events" in project.capabilities
+            )
+            # validators of the previous server mean nothing to this one
+            project.errors_validator = (None, None)
+            self.replay_buffers(project)
+            self.start_preload(project)
 
-    def get_server_version(self):
+    def fetch_server_version(self, client):
         try:
-            response = requests.get(self.server_url() + "/version")
-            return response.text
+            response = client.get("/version")
+            return client.text("/version", response)
         except Exception:
-            self.error("failed to get scalavista server version")
             return "?"
 
-    def server_version_is_outdated(self):
+    def fetch_server_capabilities(self, client):
         try:
-            latest_version = self.get_latest_server_version()
-            response = requests.get(self.server_url() + "/version")
+            response = client.get("/capabilities")
+            if response.status_code == requests.codes.ok:
+                return set(client.decode("/capabilities", response))
+        except Exception:
+            pass
+        return set()
+
+    def server_version_is_outdated(self, client):
+        if self.update_check_ttl < 0:
+            return False
+        try:
+            latest_version = latest_release(self.update_check_ttl)["version"]
+            response = client.get("/version")
             return (response.status_code != requests.codes.ok) or Version(
                 latest_version
-            ) > Version(response.text)
+            ) > Version(client.text("/version", response))
         except Exception:
             return False
 
-    def find_buffer_from_absfilepath(self, absfilepath):
-        buffers = self.nvim.buffers
-        for buffer in buffers:
-            if absfilepath.endswith(buffer.name):
-                return buffer
-        raise RuntimeError("failed to find buffer containing {}".format(absfilepath))
-
-    def reload_current_buffer(self):
-        if not self.server_alive:
-            return
-        absfilepath = self.nvim.call("expand", "%:p")
-        # if not absfilepath.endswith('.scala'):
-        #     return  # only want to load scala source files.
-        buf = self.find_buffer_from_absfilepath(absfilepath)  # self.nvim.current.buffer
-        content = "\n".join(buf)
-        data = {"filename": absfilepath, "fileContents": content}
+    # one index per scalavista.json root, kept in the cache rather than the
+    # user's tree and built in the background on first use; files outside of
+    # any project aren't indexed
+    def symbol_index_for(self, project):
+        if (
+            project is None
+            or not self.symbol_index_enabled
+            or not project.has_project_file
+        ):
+            return None
+        if project.root in self.symbol_indexes:
+            return self.symbol_indexes[project.root]
+        path = os.path.join(
+            cache_dir(),
+            "symbols",
+            "{}.db".format(
+                hashlib.sha1(project.root.encode("utf-8")).hexdigest()[:16]
+            ),
+        )
+        try:
+            index = SymbolIndex(path)
+        except (OSError, sqlite3.Error) as e:
+            self.warn("symbol index unavailable: {}".format(e))
+            index = None
+        self.symbol_indexes[project.root] = index
+        if index is not None:
+            threading.Thread(
+                target=self.update_symbol_index,
+                # nested projects are covered by their parent's index as well
+                args=(index, project_source_roots(project.root, project.config)),
+                daemon=True,
+            ).start()
+        return index
+
+    # runs on its own thread - must not touch self.nvim
+    def update_symbol_index(self, index, source_roots):
+        try:
+            changed, removed = index.update(source_roots)
+        except Exception as e:
+            self.nvim.async_call(self.warn, "symbol indexing failed: {}".format(e))
+        else:
+            if self.is_debug:
+                self.nvim.async_call(
+                    self.notify,
+                    "symbol index updated ({} changed, {} removed files)".format(
+                        changed, removed
+                    ),
+                )
+
+    @pynvim.command("ScalavistaSymbols", nargs="?")
+    def search_symbols(self, args):
+        index = self.symbol_index_for(self.current_project())
+        if index is None:
+            self.error("the symbol index is not available")
+            return
+        query = args[0] if args else self.nvim.call("expand", "<cword>")
+        rows = index.search(query, MAX_SYMBOL_RESULTS)
+        if not rows:
+            self.error("no symbols matching '{}'".format(query))
+            return
+        self.show_symbols(rows, "scalavista-symbols: {}".format(query))
+
+    def show_symbols(self, rows, title):
+        items = [
+            {
+                "filename": path,
+                "lnum": line,
+                "col": col,
+                "text": "{} {}".format(
+                    kind, container + "." + name if container else name
+                ),
+            }
+            for name, kind, path, line, col, container in rows
+        ]
+        self.nvim.call("setloclist", 0, [], " ", {"items": items, "title": title})
+        self.nvim.command("lopen")
+
+    def goto_symbol_fallback(self, word):
+        index = self.symbol_index_for(self.current_project())
+        rows = index.lookup(word) if index is not None else []
+        if not rows:
+            self.error("unable to find definition of {}".format(word))
+        elif len(rows) == 1 or rows[1][1] not in TYPE_KINDS:
+            name, kind, path, line, col, container = rows[0]
+            if path != self.nvim.call("expand", "%:p"):
+                self.nvim.command("edit {}".format(path))
+            self.nvim.call("cursor", line, col)
+        else:
+            self.show_symbols(rows, "scalavista-definitions: {}".format(word))
+
+    def start_preload(self, project):
+        # without a scalavista.json the root is merely nvim's cwd, which may
+        # well be $HOME - never walk and upload that
+        if not self.preload_enabled or not project.has_project_file:
+            return
+        self.cancel_preload(project)
+        cancel = threading.Event()
+        project.preload_cancel = cancel
+        manifest_path = os.path.join(
+            cache_dir(),
+            "preload",
+            "{}.json".format(
+                hashlib.sha1(
+                    "{}\0{}".format(project.root, project.scala_version).encode(
+                        "utf-8"
+                    )
+                ).hexdigest()[:16]
+            ),
+        )
+        thread = threading.Thread(
+            target=self.preload_project,
+            args=(
+                project.client,
+                project.source_roots(),
+                manifest_path,
+                project.instance_id(),
+                "reload-files" in project.capabilities,
+                cancel,
+            ),
+            daemon=True,
+        )
+        thread.start()
+
+    def cancel_preload(self, project):
+        if project.preload_cancel is not None:
+            project.preload_cancel.set()
+            project.preload_cancel = None
+
+    # runs on its own thread - must not touch self.nvim
+    def preload_project(
+        self, client, source_roots, manifest_path, server_id, batched, cancel
+    ):
+        manifest = load_json_file(manifest_path, {})
+        # the server only still has what we sent if it is the same instance
+        if manifest.get("server") == server_id:
+            known = manifest.get("files", {})
+        else:
+            known = {}
+        paths = list(iter_project_sources(source_roots, skip_nested_projects=True))
+        self.nvim.async_call(
+            self.notify, "preloading {} source files".format(len(paths))
+        )
+        entries = {}
+        batch = []
+        progress = {"sent": 0, "bytes": 0, "reported": time.monotonic()}
+
+        def flush():
+            # one batch in flight at a time keeps memory bounded and leaves
+            # the server room to answer interactive requests
+            self.send_preload_batch(client, batch, batched)
+            for sent_path, _, sent_entry in batch:
+                entries[sent_path] = sent_entry
+            progress["sent"] += len(batch)
+            progress["bytes"] = 0
+            del batch[:]
+            if time.monotonic() - progress["reported"] > PRELOAD_PROGRESS_INTERVAL:
+                progress["reported"] = time.monotonic()
+                self.nvim.async_call(
+                    self.notify,
+                    "preloaded {}/{} source files".format(progress["sent"], len(paths)),
+                )
+
         try:
-            r = requests.post(self.server_url() + "/reload-file", json=data)
-            if r.status_code != requests.codes.ok:
-                self.error("failed to reload buffer")
+            for path in paths:
+                if cancel.is_set():
+                    return
+                try:
+                    stat = os.stat(path)
+                    entry = known.get(path)
+                    if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+                        entries[path] = entry
+                        continue
+                    with open(path, "rb") as f:
+                        content = f.read()
+                except OSError:
+                    continue
+                digest = hashlib.sha1(content).hexdigest()
+                entry = [stat.st_mtime_ns, stat.st_size, digest]
+                if path in known and known[path][2] == digest:
+                    entries[path] = entry  # touched but unchanged
+                    continue
+                if path in self.open_files:
+                    continue  # buffer sync owns the contents of open files
+                batch.append((path, content.decode("utf-8", "replace"), entry))
+                progress["bytes"] += len(content)
+                if (
+                    progress["bytes"] >= PRELOAD_BATCH_BYTES
+                    or len(batch) >= PRELOAD_BATCH_FILES
+                ):
+                    flush()
+            if batch:
+                flush()
         except Exception as e:
+            self.nvim.async_call(self.warn, "preloading sources failed: {}".format(e))
+        else:
+            self.nvim.async_call(
+                self.notify,
+                "preloading done - sent {} of {} source files".format(
+                    progress["sent"], len(paths)
+                ),
+            )
+        finally:
+            save_json_file(manifest_path, {"server": server_id, "files": entries})
+
+    def send_preload_batch(self, client, batch, batched):
+        if batched:
+            data = {
+                "files": [
+                    {"filename": path, "fileContents": content}
+                    for path, content, _ in batch
+                ]
+            }
+            self.post_reload(client, "/reload-files", data)
+            return
+        for path, content, _ in batch:
+            self.post_reload(
+                client, "/reload-file", {"filename": path, "fileContents": content}
+            )
+
+    def attach_buffer(self, bufnr):
+        if bufnr in self.sync_states:
+            return self.sync_states[bufnr]
+        filename = self.nvim.api.buf_get_name(bufnr)
+        if not filename.endswith(SOURCE_EXTENSIONS):
+            return None
+        if not self.nvim.exec_lua(BUF_ATTACH_LUA, [bufnr]):
+            self.error("failed to attach to buffer {}".format(filename))
+            return None
+        state = BufferSyncState(bufnr, filename, self.project_for(filename))
+        self.sync_states[bufnr] = state
+        self.open_files.add(filename)
+        return state
+
+    @pynvim.function("ScalavistaOnLines")
+    def on_lines(self, args):
+        bufnr, tick, first, last, last_new = args
+        state = self.sync_states.get(bufnr)
+        if state is None:
+            return
+        state.record_edit(first, last, last_new)
+        state.edit_tick = tick
+        state.snapshot = None
+        self.schedule_sync()
+        self.poke_refresh()
+
+    # :edit! and the like replace the whole buffer without on_lines events
+    @pynvim.function("ScalavistaOnReload")
+    def on_reload(self, args):
+        state = self.sync_states.get(args[0])
+        if state is None:
+            return
+        state.invalidate()
+        state.snapshot = None
+        self.schedule_sync()
+
+    @pynvim.function("ScalavistaOnDetach")
+    def on_detach(self, args):
+        state = self.sync_states.pop(args[0], None)
+        if state is not None:
+            self.open_files.discard(state.filename)
+
+    def schedule_sync(self):
+        self.last_edit_time = time.monotonic()
+        if self.sync_timer is None:
+            self.sync_timer = self.nvim.call(
+                "timer_start", self.sync_debounce_ms, "ScalavistaFlushSync"
+            )
+
+    @pynvim.function("ScalavistaFlushSync")
+    def flush_sync(self, timer):
+        self.sync_timer = None
+        quiet_ms = (time.monotonic() - self.last_edit_time) * 1000
+        if quiet_ms < self.sync_debounce_ms:
+            # still typing - push the send out to the end of the quiet period
+            self.sync_timer = self.nvim.call(
+                "timer_start",
+                int(self.sync_debounce_ms - quiet_ms) + 1,
+                "ScalavistaFlushSync",
+            )
+            return
+        self.sync_all_buffers()
+
+    def get_snapshot(self, state, tick=None):
+        if tick is None:
+            tick = self.nvim.api.buf_get_changedtick(state.bufnr)
+        if state.snapshot is None or state.snapshot.tick != tick:
+            with self.stats.timed("buffer.serialize"):
+                lines = self.nvim.buffers[state.bufnr][:]
+                state.snapshot = BufferSnapshot(tick, lines)
+        return state.snapshot
+
+    def sync_all_buffers(self):
+        for state in list(self.sync_states.values()):
+            self.sync_buffer(state)
+
+    def sync_current_buffer(self):
+        state = self.attach_buffer(self.nvim.current.buffer.number)
+        if state is not None:
+            self.sync_buffer(state)
+
+    def sync_buffer(self, state):
+        project = state.project
+        if state.in_flight:
+            return
+        tick = self.nvim.api.buf_get_changedtick(state.bufnr)
+        if tick == state.synced_tick:
+            return
+        # an edit counts as use and wakes up a server stopped for idleness
+        self.activate_project(project)
+        if not project.alive:
+            return
+        lines = None
+        if (
+            not state.needs_full
+            and state.dirty is not None
+            and tick == state.edit_tick
+            and "reload-file-delta" in project.capabilities
+        ):
+            start, old_end, new_end = state.dirty
+            # tick and lines in one go, so that no edit can slip in between
+            (tick, lines), _ = self.nvim.api.call_atomic(
+                [
+                    ["nvim_buf_get_changedtick", [state.bufnr]],
+                    ["nvim_buf_get_lines", [state.bufnr, start, new_end, False]],
+                ]
+            )
+        if state.needs_full:
+            endpoint = "/reload-file"
+            data = {
+                "filename": state.filename,
+                "fileContents": self.get_snapshot(state, tick).content,
+            }
+        elif state.dirty is None:
+            # changedtick moved without touching any lines
+            state.synced_tick = tick
+            return
+        elif lines is not None and tick == state.edit_tick:
+            endpoint = "/reload-file-delta"
+            data = {
+                "filename": state.filename,
+                "start": start,
+                "end": old_end,
+                "lines": lines,
+            }
+        else:
+            endpoint = "/reload-file"
+            data = {
+                "filename": state.filename,
+                "fileContents": self.get_snapshot(state, tick).content,
+            }
+        state.in_flight = True
+        state.needs_full = False
+        state.dirty = None
+        self.run_async(
+            project.client,
+            self.post_reload,
+            functools.partial(self.on_buffer_synced, state, state.epoch, tick),
+            functools.partial(self.on_buffer_sync_failed, state, state.epoch),
+            project.client,
+            endpoint,
+            data,
+            priority=PRIORITY_RELOAD,
+        )
+
+    # a fresh server knows nothing about our buffers - after a (re)start all
+    # of the project's open buffers are sent in a single request
+    def replay_buffers(self, project):
+        states = [
+            state for state in self.sync_states.values() if state.project is project
+        ]
+        for state in states:
+            state.invalidate()
+        states = [state for state in states if not state.in_flight]
+        if len(states) < 2 or "reload-files" not in project.capabilities:
+            for state in states:
+                self.sync_buffer(state)
+            return
+        files = []
+        ticks = []
+        for state in states:
+            tick = self.nvim.api.buf_get_changedtick(state.bufnr)
+            files.append(
+                {
+                    "filename": state.filename,
+                    "fileContents": self.get_snapshot(state, tick).content,
+                }
+            )
+            ticks.append(tick)
+            state.in_flight = True
+            state.needs_full = False
+            state.dirty = None
+        self.touch(project)
+        epochs = [state.epoch for state in states]
+        self.run_async(
+            project.client,
+            self.post_reload,
+            functools.partial(self.on_buffers_replayed, states, epochs, ticks),
+            functools.partial(self.on_buffer_replay_failed, states, epochs),
+            project.client,
+            "/reload-files",
+            {"files": files},
+            priority=PRIORITY_RELOAD,
+        )
+
+    def on_buffers_replayed(self, states, epochs, ticks, _):
+        for state, epoch, tick in zip(states, epochs, ticks):
+            self.on_buffer_synced(state, epoch, tick, None)
+
+    def on_buffer_replay_failed(self, states, epochs, e):
+        for state, epoch in zip(states, epochs):
+            state.in_flight = False
+            if epoch == state.epoch:
+                state.invalidate()
+        self.error("failed to reload buffers: {}".format(e))
+
+    def post_reload(self, client, endpoint, data):
+        r = client.post(endpoint, data)
+        if r.status_code != requests.codes.ok:
+            raise RuntimeError("bad server response: {}".format(r.status_code))
+
+    def on_buffer_synced(self, state, epoch, tick, _):
+        state.in_flight = False
+        if epoch != state.epoch:
+            # the server was replaced while the request was in flight
+            self.schedule_sync()
+            return
+        state.synced_tick = tick
+        if state.dirty is not None:
+            self.schedule_sync()
+
+    def on_buffer_sync_failed(self, state, epoch, e):
+        state.in_flight = False
+        if epoch == state.epoch:
+            state.invalidate()
             self.error("failed to reload buffer: {}".format(e))
 
-    def update_errors_and_populate_quickfix(self):
-        if not self.server_alive:
+    # runs on a worker thread - must not touch self.nvim
+    def fetch_errors(self, client, etag, body):
+        headers = {"If-None-Match": etag} if etag is not None else {}
+        response = client.get("/errors", headers=headers)
+        if response.status_code == requests.codes.not_modified:
+            self.stats.count("errors unchanged")
+            return None
+        if response.status_code != requests.codes.ok:
+            raise RuntimeError("bad server response: {}".format(response.status_code))
+        content = response.content
+        if content == body:
+            self.stats.count("errors unchanged")
+            return None  # servers without ETag support: skip the parse
+        etag = response.headers.get("ETag")
+        return (
+            etag,
+            content if etag is None else None,
+            client.decode("/errors", response),
+        )
+
+    def update_errors_and_populate_quickfix(self, projects=None):
+        if projects is None:
+            projects = list(self.projects.values())
+        projects = [project for project in projects if project.alive]
+        if not projects:
             return
         mode = self.nvim.api.get_mode()["mode"]
         if mode == "i":
+            self.errors_stale = True
             return  # don't update errors when in insert mode
-        try:
-            response = requests.get(self.server_url() + "/errors")
-            new_errors = response.json()
-            if str(new_errors) == str(self.errors):
+        self.errors_stale = False
+        for project in projects:
+            self.run_async(
+                project.client,
+                self.fetch_errors,
+                functools.partial(self.on_errors_fetched, project),
+                None,
+                project.client,
+                *project.errors_validator,
+                priority=PRIORITY_ERRORS,
+                key="errors"
+            )
+
+    def on_errors_fetched(self, project, result):
+        if result is not None:
+            self.populate_quickfix(project, result)
+
+    def populate_quickfix(self, project, result):
+        etag, body, new_errors = result
+        project.errors_validator = (etag, body)
+        if project.awaiting_first_diagnostics and project.launch_time is not None:
+            project.awaiting_first_diagnostics = False
+            self.notify(
+                "first diagnostics {:.1f}s after server launch".format(
+                    time.monotonic() - project.launch_time
+                )
+            )
+        project.diagnostics = parse_diagnostics(new_errors)
+        # each server only reports on the files of its own project
+        self.diagnostics = [
+            diagnostic
+            for each in self.projects.values()
+            for diagnostic in each.diagnostics
+        ]
+        self.render_diagnostics(self.diagnostics, update_quickfix=True)
+
+    def sign_name(self, severity):
+        if severity == "ERROR":
+            return self.error_sign
+        elif severity == "WARNING":
+            return self.warning_sign
+        return self.info_sign
+
+    def highlight_call(self, bufnr, diagnostic):
+        n_bytes = (diagnostic.end - diagnostic.start) // 2
+        return [
+            "nvim_buf_add_highlight",
+            [
+                bufnr,
+                self.namespace,
+                "ScalavistaUnderlineStyle",
+                diagnostic.lnum - 1,
+                diagnostic.col - 1,
+                diagnostic.col + n_bytes,
+            ],
+        ]
+
+    def render_diagnostics(self, diagnostics, update_quickfix=False):
+        with self.stats.timed("render.diagnostics"):
+            by_path = {}
+            for diagnostic in diagnostics:
+                by_path.setdefault(diagnostic.path, []).append(diagnostic)
+            for path, path_diagnostics in by_path.items():
+                path_diagnostics.sort(key=lambda diagnostic: diagnostic.lnum)
+                by_path[path] = (
+                    [diagnostic.lnum for diagnostic in path_diagnostics],
+                    path_diagnostics,
+                )
+            self.diagnostics_by_path = by_path
+            self.lazy_diagnostics = len(diagnostics) > self.lazy_diagnostics_threshold
+            if self.lazy_diagnostics:
+                # draw what is on screen now and the rest in the background
+                wanted = self.visible_diagnostics()
+                for path, (_, signs) in self.rendered_diagnostics.items():
+                    current = set(by_path.get(path, ([], []))[1])
+                    wanted.setdefault(path, set()).update(
+                        diagnostic for diagnostic in signs if diagnostic in current
+                    )
+            else:
+                wanted = {
+                    path: set(path_diagnostics)
+                    for path, (_, path_diagnostics) in by_path.items()
+                }
+                for path in self.rendered_diagnostics:
+                    wanted.setdefault(path, set())
+            calls = []
+            if update_quickfix:
+                if self.lazy_diagnostics:
+                    self.qflist_filled = min(len(diagnostics), QUICKFIX_FILL_CHUNK)
+                else:
+                    self.qflist_filled = len(diagnostics)
+                what = {
+                    "items": quickfix_items(diagnostics[: self.qflist_filled]),
+                    "title": QUICKFIX_TITLE,
+                }
+                # replace our own list in place while it is still in the
+                # stack, so that the user's :grep or :make results survive
+                if (
+                    self.qflist_id is not None
+                    and self.nvim.call("getqflist", {"id": self.qflist_id})["id"]
+                ):
+                    what["id"] = self.qflist_id
+                    calls.append(["nvim_call_function", ["setqflist", [[], "r", what]]])
+                else:
+                    calls.append(["nvim_call_function", ["setqflist", [[], " ", what]]])
+                    # later chunks go to this list even if another one is pushed
+                    calls.append(["nvim_call_function", ["getqflist", [{"id": 0}]]])
+                self.last_echoed = None
+            results = self.render_diagnostics_batch(wanted, calls)
+            if update_quickfix and len(calls) == 2 and len(results) == 2:
+                self.qflist_id = results[1]["id"]
+            if self.lazy_diagnostics:
+                self.schedule_fill()
+
+    def visible_diagnostics(self):
+        wanted = {}
+        for path, top, bottom in self.nvim.exec_lua(VISIBLE_WINDOWS_LUA, []):
+            if path not in self.diagnostics_by_path:
+                continue
+            lines, path_diagnostics = self.diagnostics_by_path[path]
+            first = bisect.bisect_left(lines, top - VIEWPORT_MARGIN)
+            last = bisect.bisect_right(lines, bottom + VIEWPORT_MARGIN)
+            wanted.setdefault(path, set()).update(path_diagnostics[first:last])
+        return wanted
+
+    def render_visible_diagnostics(self):
+        wanted = self.visible_diagnostics()
+        for path, new in wanted.items():
+            new.update(self.rendered_diagnostics.get(path, (-1, {}))[1])
+        self.render_diagnostics_batch(wanted, [])
+        self.schedule_fill()
+
+    # the next batch of undrawn diagnostics of loaded buffers
+    def pending_diagnostics(self, budget):
+        loaded = self.nvim.exec_lua(LOADED_BUFFERS_LUA, [])
+        wanted = {}
+        for path in loaded:
+            if path not in self.diagnostics_by_path:
+                continue
+            _, path_diagnostics = self.diagnostics_by_path[path]
+            bufnr, signs = self.rendered_diagnostics.get(path, (0, {}))
+            if bufnr < 0:
+                continue  # no buffer by that name
+            # identical diagnostics share a sign, so compare by membership
+            missing = [
+                diagnostic
+                for diagnostic in dict.fromkeys(path_diagnostics)
+                if diagnostic not in signs
+            ][:budget]
+            if not missing:
+                continue  # nothing left to draw
+            wanted[path] = set(signs).union(missing)
+            budget -= len(missing)
+            if budget <= 0:
+                break
+        return wanted
+
+    def schedule_fill(self):
+        if self.fill_timer is None:
+            self.fill_timer = self.nvim.call(
+                "timer_start", FILL_INTERVAL_MS, "ScalavistaFillDiagnostics"
+            )
+
+    # one chunk per timer tick, so that keystrokes are handled in between
+    @pynvim.function("ScalavistaFillDiagnostics")
+    def fill_diagnostics(self, timer):
+        self.fill_timer = None
+        if not self.lazy_diagnostics:
+            return
+        calls = []
+        if self.qflist_filled < len(self.diagnostics) and self.qflist_id is not None:
+            end = self.qflist_filled + QUICKFIX_FILL_CHUNK
+            chunk = quickfix_items(self.diagnostics[self.qflist_filled : end])
+            self.qflist_filled = min(end, len(self.diagnostics))
+            calls.append(
+                [
+                    "nvim_call_function",
+                    ["setqflist", [[], "a", {"id": self.qflist_id, "items": chunk}]],
+                ]
+            )
+        with self.stats.timed("render.diagnostics.fill"):
+            wanted = self.pending_diagnostics(DIAGNOSTICS_FILL_CHUNK)
+            if not wanted and not calls:
                 return
-            self.errors = new_errors
-        except Exception:
-            # self.error('failed to get errors')
-            pass
+            self.render_diagnostics_batch(wanted, calls)
+        self.schedule_fill()
+
+    # brings the drawn diagnostics of the given paths in line with wanted
+    # (path -> diagnostics) in a single atomic call; the results of
+    # extra_calls are returned
+    def render_diagnostics_batch(self, wanted, extra_calls):
+        changed = []
+        for path, new in wanted.items():
+            old = self.rendered_diagnostics.get(path)
+            if old is None:
+                if new:
+                    changed.append(path)
+            elif not new or old[1].keys() != new:
+                changed.append(path)
+        calls = []
+        # calls on buffers that may have been wiped go last, so that a
+        # failure there cannot abort the rest of the batch
+        stale_calls = []
+        if changed:
+            bufnrs, _ = self.nvim.api.call_atomic(
+                [["nvim_call_function", ["bufnr", [path]]] for path in changed]
+            )
         else:
-            self.nvim.call("clearmatches")
-            self.nvim.command("sign unplace *")
-            qflist = []
-            infos = []
-            warnings = []
-            errors = []
-            lines = []
-            for i, error in enumerate(self.errors):
-                path, lnum, col, start, end, text, severity = error
-                n_bytes = (int(end) - int(start)) // 2
-                lines.append([int(lnum), int(col), n_bytes + 1])
-                qflist.append(
-                    {"filename": path, "lnum": int(lnum), "text": severity + ":" + text}
-                )
-                if severity == "ERROR":
-                    errors.append((lnum, path))
-                elif severity == "WARNING":
-                    warnings.append((lnum, path))
+            bufnrs = []
+        unplace = []
+        place = []
+        for path, bufnr in zip(changed, bufnrs):
+            old_bufnr, old_signs = self.rendered_diagnostics.get(path, (-1, {}))
+            new = wanted[path]
+            if old_bufnr != bufnr:
+                if old_bufnr > 0:
+                    unplace.extend(
+                        {"group": SIGN_GROUP, "id": sign_id, "buffer": old_bufnr}
+                        for sign_id in old_signs.values()
+                    )
+                    stale_calls.append(
+                        ["nvim_buf_clear_namespace", [old_bufnr, self.namespace, 0, -1]]
+                    )
+                old_signs = {}
+            signs = {}
+            dirty_lines = set()
+            for diagnostic, sign_id in old_signs.items():
+                if diagnostic in new:
+                    signs[diagnostic] = sign_id
                 else:
-                    infos.append((lnum, path))
-
-            sign_idx = 1
-            for msgs, sign in [
-                (infos, self.info_sign),
-                (warnings, self.warning_sign),
-                (errors, self.error_sign),
-            ]:
-                for lnum, path in msgs:
-                    try:
-                        self.nvim.command(
-                            "sign place {} line={} name={} file={}".format(
-                                sign_idx, lnum, sign, path
-                            )
-                        )
-                    except Exception:
-                        pass
-                    sign_idx += 1
-
-            self.nvim.call("setqflist", qflist)
-            self.nvim.command('let w:quickfix_title="neovim-scalavista"')
-            self.nvim.call("matchaddpos", "ScalavistaUnderlineStyle", lines)
-            self.qflist = self.nvim.call("getqflist")
-            # self.nvim.command('cw')
-            # self.nvim.command('wincmd p')
-
-    def get_completion(self, completion_type="type"):
-        if not self.server_alive:
+                    unplace.append(
+                        {"group": SIGN_GROUP, "id": sign_id, "buffer": bufnr}
+                    )
+                    dirty_lines.add(diagnostic.lnum)
+            if bufnr > 0:
+                for diagnostic in new:
+                    if diagnostic in signs:
+                        continue
+                    self.last_sign_id += 1
+                    signs[diagnostic] = self.last_sign_id
+                    place.append(
+                        {
+                            "group": SIGN_GROUP,
+                            "id": self.last_sign_id,
+                            "name": self.sign_name(diagnostic.severity),
+                            "buffer": bufnr,
+                            "lnum": diagnostic.lnum,
+                            "priority": SIGN_PRIORITIES.get(
+                                diagnostic.severity, DEFAULT_SIGN_PRIORITY
+                            ),
+                        }
+                    )
+                    dirty_lines.add(diagnostic.lnum)
+                # highlights are cleared and redrawn a whole line at a time
+                for lnum in dirty_lines:
+                    calls.append(
+                        [
+                            "nvim_buf_clear_namespace",
+                            [bufnr, self.namespace, lnum - 1, lnum],
+                        ]
+                    )
+                calls.extend(
+                    self.highlight_call(bufnr, diagnostic)
+                    for diagnostic in new
+                    if diagnostic.lnum in dirty_lines
+                )
+            if new:
+                # diagnostics of unloaded files are kept unrendered until the
+                # file is opened
+                self.rendered_diagnostics[path] = (bufnr, signs)
+            else:
+                self.rendered_diagnostics.pop(path, None)
+        if unplace:
+            calls.append(["nvim_call_function", ["sign_unplacelist", [unplace]]])
+        if place:
+            calls.append(["nvim_call_function", ["sign_placelist", [place]]])
+        extra_index = len(calls)
+        calls.extend(extra_calls)
+        calls.extend(stale_calls)
+        if not calls:
             return []
-        window = self.nvim.current.window
-        cursor = window.cursor
+        results, err = self.nvim.api.call_atomic(calls)
+        if err is not None:
+            self.error("failed to render diagnostics: {}".format(err[2]))
+        return results[extra_index : extra_index + len(extra_calls)]
+
+    # looked up by path rather than buffer, so that lines of files that
+    # haven't been drawn yet are covered too
+    def diagnostics_message(self, path, lnum):
+        if path not in self.diagnostics_by_path:
+            return None
+        lines, path_diagnostics = self.diagnostics_by_path[path]
+        first = bisect.bisect_left(lines, lnum)
+        last = bisect.bisect_right(lines, lnum)
+        if first == last:
+            return None
+        return " | ".join(
+            diagnostic.severity + ":" + diagnostic.text
+            for diagnostic in path_diagnostics[first:last]
+        )
+
+    def render_pending_diagnostics(self, path, bufnr):
+        rendered = self.rendered_diagnostics.get(path)
+        if rendered is not None and 0 < rendered[0] != bufnr:
+            # the buffer was wiped and the file opened again under a new
+            # number - whatever was drawn went with the old buffer
+            del self.rendered_diagnostics[path]
+            rendered = None
+        if self.lazy_diagnostics:
+            self.render_visible_diagnostics()
+            return
+        if path in self.diagnostics_by_path and (rendered is None or rendered[0] < 0):
+            self.render_diagnostics(self.diagnostics)
+
+    def current_snapshot(self):
         buf = self.nvim.current.buffer
-        offset = get_offset_from_cursor(buf[:], cursor)
-        content = "\n".join(buf)
-        file_name = self.nvim.call("expand", "%:p")
-        data = {"filename": file_name, "fileContents": content, "offset": offset}
-        resp = requests.post(
-            self.server_url() + "/{}-completion".format(completion_type), json=data
+        state = self.attach_buffer(buf.number)
+        if state is None:
+            tick = self.nvim.api.buf_get_changedtick(buf.number)
+            return self.nvim.call("expand", "%:p"), BufferSnapshot(tick, buf[:])
+        return state.filename, self.get_snapshot(state)
+
+    def build_position_request(self):
+        file_name, snapshot = self.current_snapshot()
+        cursor = self.nvim.current.window.cursor
+        with self.stats.timed("buffer.offset"):
+            offset = snapshot.offset(cursor)
+        data = {
+            "filename": file_name,
+            "fileContents": snapshot.content,
+            "offset": offset,
+        }
+        return data, snapshot
+
+    # runs on a worker thread - must not touch self.nvim
+    def fetch_completion(self, client, completion_type, data):
+        resp = client.post("/{}-completion".format(completion_type), data)
+        if resp.status_code != requests.codes.ok:
+            raise RuntimeError("bad server response: {}".format(resp.status_code))
+        return client.decode("/{}-completion".format(completion_type), resp)
+
+    def get_completions(self):
+        project = self.current_project()
+        if project is None:
+            return []
+        self.activate_project(project)
+        if not project.alive:
+            return []
+        data, snapshot = self.build_position_request()
+        key = (data["filename"], data["offset"])
+        if self.completion_cache is not None:
+            cached_key, tick, content, items = self.completion_cache
+            # vim strips the base before asking for matches, so refining the
+            # base leaves the contents unchanged even though changedtick moves
+            if cached_key == key and (
+                tick == snapshot.tick or content == snapshot.content
+            ):
+                self.stats.count("completion cache hit")
+                return items
+        items, complete = self.merge_completions(
+            self.request_completions(project, data)
         )
-        if resp.status_code == requests.codes.ok:
-            res = []
-            for word, menu, kind in resp.json():
-                kind_abbr = 'v'
-                if kind == 'method':
-                    kind_abbr = 'f'
-                elif kind in ['class', 'trait', 'object']:
-                    kind_abbr = 'm'
-                res.append({"word": word, "menu": menu, "kind": kind_abbr, "dup": 1})
-            return res
-        self.error("failed to get {} completion".format(completion_type))
-        return []
+        if complete:
+            self.completion_cache = (key, snapshot.tick, snapshot.content, items)
+        return items
+
+    def request_completions(self, project, data):
+        return [
+            (
+                completion_type,
+                project.client.submit(
+                    self.fetch_completion,
+                    project.client,
+                    completion_type,
+                    data,
+                    priority=PRIORITY_COMPLETION,
+                    key=("completion", completion_type),
+                ),
+            )
+            for completion_type in COMPLETION_TYPES
+        ]
+
+    def merge_completions(self, futures):
+        items = []
+        seen = set()
+        complete = True
+        for completion_type, future in futures:
+            try:
+                candidates = future.result()
+            except Exception as e:
+                if not isinstance(e, concurrent.futures.CancelledError):
+                    self.error(
+                        "failed to get {} completion: {}".format(completion_type, e)
+                    )
+                complete = False
+                continue
+            for word, menu, kind in candidates:
+                if (word, menu) in seen:
+                    continue
+                seen.add((word, menu))
+                items.append(completion_item(word, menu, kind))
+        return items, complete
+
+    @pynvim.autocmd(
+        "TextChangedI",
+        pattern="*.scala,*.java",
+        eval='[bufnr(), line("."), col(".") - 1, getline(".")]',
+    )
+    def on_text_changed_i(self, args):
+        if not self.async_completion:
+            return
+        bufnr, row, col_bytes, line = args
+        state = self.attach_buffer(bufnr)
+        if state is None or not state.project.alive:
+            return
+        # every keystroke supersedes whatever is still in flight
+        for _, future in self.pending_completions:
+            future.cancel()
+        self.pending_completions = []
+        col = len(line.encode("utf-8")[:col_bytes].decode("utf-8", "ignore"))
+        start = find_completion_start(line, col)
+        base = line[start:col]
+        if not base and (start == 0 or line[start - 1] != "."):
+            return  # only pop up while typing a word or after a member selection
+        startcol = len(line[:start].encode("utf-8")) + 1
+        context = (bufnr, row, startcol, line[:start], line[col:])
+        if self.async_completion_cache is not None:
+            cached_context, items = self.async_completion_cache
+            if cached_context == context:
+                self.show_completions(row, col_bytes, startcol, base, items)
+                return
+        snapshot = self.get_snapshot(state)
+        # ask for completions at the start of the word, with the word itself
+        # stripped, so that refining it can be answered from the cache
+        lines = list(snapshot.lines)
+        lines[row - 1] = line[:start] + line[col:]
+        data = {
+            "filename": state.filename,
+            "fileContents": "\n".join(lines),
+            "offset": snapshot.line_offsets[row - 1] + jvm_length(line[:start]),
+        }
+        futures = self.request_completions(state.project, data)
+        self.pending_completions = futures
+        for _, future in futures:
+            future.add_done_callback(
+                lambda _: self.nvim.async_call(
+                    self.on_async_completion,
+                    futures,
+                    (context, row, col_bytes, base),
+                )
+            )
+
+    def on_async_completion(self, futures, request):
+        if futures is not self.pending_completions:
+            return  # superseded by a newer keystroke or already shown
+        if not all(future.done() for _, future in futures):
+            return
+        self.pending_completions = []
+        context, row, col_bytes, base = request
+        items, complete = self.merge_completions(futures)
+        if complete:
+            self.async_completion_cache = (context, items)
+        self.show_completions(row, col_bytes, context[2], base, items)
+
+    def show_completions(self, row, col_bytes, startcol, base, items):
+        if not self.nvim.api.get_mode()["mode"].startswith("i"):
+            return
+        if tuple(self.nvim.current.window.cursor) != (row, col_bytes):
+            return
+        matches = rank_completions(base, items, self.max_completions)
+        if self.completion_callback:
+            self.nvim.call(self.completion_callback, startcol, matches)
+        else:
+            self.nvim.call("complete", startcol, matches)
+
+    # runs on a worker thread - must not touch self.nvim
+    def poll_server(self, project, was_alive, want_errors, etag, body):
+        health = self.probe_health(project, was_alive)
+        errors = None
+        if health is not None and want_errors:
+            if not was_alive:
+                etag, body = None, None
+            try:
+                errors = self.fetch_errors(project.client, etag, body)
+            except Exception:
+                pass
+        return health, errors
+
+    def on_server_polled(self, project, result):
+        project.refresh_pending = False
+        health, errors = result
+        was_alive = project.alive
+        self.apply_health(project, health)
+        if errors is not None:
+            self.populate_quickfix(project, errors)
+        if errors is not None or was_alive != project.alive or project.starting:
+            self.poll_activity = True
+            self.poke_refresh()
+
+    def on_server_poll_failed(self, project, e):
+        project.refresh_pending = False
+
+    def polled_projects(self):
+        # shared servers are watched even while down, to take over from them
+        return [
+            project
+            for project in self.projects.values()
+            if project.running() or project.registry is not None
+        ]
+
+    def schedule_refresh(self, delay_ms):
+        polled = self.polled_projects()
+        if polled and all(p.push_mode and not p.starting for p in polled):
+            # events tell us about new errors; polling only watches liveness
+            delay_ms = self.max_poll_interval_ms
+        if self.refresh_timer is not None:
+            self.nvim.call("timer_stop", self.refresh_timer)
+        self.refresh_timer = self.nvim.call(
+            "timer_start", delay_ms, "ScalavistaRefresh"
+        )
+
+    def poke_refresh(self):
+        if self.poll_interval_ms > MIN_POLL_INTERVAL_MS:
+            self.poll_interval_ms = MIN_POLL_INTERVAL_MS
+            self.schedule_refresh(self.poll_interval_ms)
 
     @pynvim.function("ScalavistaRefresh")
     def update_errors(self, timer):
-        self.check_health()
-        self.update_errors_and_populate_quickfix()
+        self.refresh_timer = None
+        polled = self.polled_projects()
+        if self.poll_activity or any(project.starting for project in polled):
+            self.poll_interval_ms = MIN_POLL_INTERVAL_MS
+        else:
+            # nothing happened - back off while the servers are idle
+            self.poll_interval_ms = min(
+                2 * self.poll_interval_ms, self.max_poll_interval_ms
+            )
+        self.poll_activity = False
+        # don't update errors when in insert mode
+        want_errors = self.nvim.api.get_mode()["mode"] != "i"
+        if not want_errors:
+            self.errors_stale = True
+        for project in polled:
+            if project.refresh_pending:
+                continue  # the previous tick is still waiting for this server
+            project.refresh_pending = True
+            self.run_async(
+                project.client,
+                self.poll_server,
+                functools.partial(self.on_server_polled, project),
+                functools.partial(self.on_server_poll_failed, project),
+                project,
+                project.alive,
+                want_errors,
+                *project.errors_validator,
+                priority=PRIORITY_ERRORS
+            )
+        self.stop_idle_servers()
+        if (
+            self.shared_server
+            and time.monotonic() - self.last_orphan_reap > ORPHAN_REAP_INTERVAL
+        ):
+            self.last_orphan_reap = time.monotonic()
+            threading.Thread(target=reap_orphaned_servers, daemon=True).start()
+        self.schedule_refresh(self.poll_interval_ms)
 
     @pynvim.function("ScalavistaCompleteFunc", sync=True)
     def scala_complete_func(self, findstart_and_base):
@@ -505,75 +3408,99 @@ class Scalavista(object):
             row = cursor[0]
             col = cursor[1]
             line = self.nvim.current.line
-            startcol = col
-            while startcol > 0 and line[startcol - 1] not in " .,([{":
-                startcol -= 1
+            startcol = find_completion_start(line, col)
             return row, col, startcol if startcol else 1
 
         if str(findstart) == "1":
             row, col, startcol = detect_row_column_start()
             return startcol
         else:
-            type_completion = self.get_completion("type") + self.get_completion("scope")
-            return [comp for comp in type_completion if comp["word"].startswith(base)]
+            return rank_completions(
+                base, self.get_completions(), self.max_completions
+            )
+
+    def ask_at_cursor(self, endpoint, callback):
+        project = self.current_project()
+        if project is None:
+            return
+        self.activate_project(project)
+        if not project.alive:
+            return
+        data, snapshot = self.build_position_request()
+        key = (data["filename"], snapshot.tick, data["offset"], endpoint)
+        cached = self.hover_cache.get(key)
+        if cached is not None:
+            self.stats.count("hover cache hit")
+            callback(cached)
+            return
+        if key in self.pending_queries:
+            # e.g. :ScalavistaType while the CursorHold prefetch is in flight
+            self.pending_queries[key].append(callback)
+            return
+        self.pending_queries[key] = [callback]
+
+        def ask():
+            resp = project.client.post(endpoint, data)
+            if resp.status_code == requests.codes.ok:
+                return resp
+            return None
+
+        def deliver(resp):
+            if resp is not None:
+                self.hover_cache.put(key, resp)
+            for waiting in self.pending_queries.pop(key, []):
+                waiting(resp)
+
+        self.run_async(project.client, ask, deliver, lambda e: deliver(None))
+
+    def echo_info_at(self, endpoint, what):
+        project = self.current_project()
+        if project is None:
+            return
+        client = project.client
+
+        def show(resp):
+            if resp is not None:
+                self.nvim.out_write(client.text(endpoint, resp) + "\n")
+            else:
+                self.error("server error when getting {} under cursor".format(what))
+
+        self.ask_at_cursor(endpoint, show)
 
     @pynvim.command("ScalavistaType")
     def get_type_at(self):
-        tpe = self.get_info_at("/ask-type-at")
-        if tpe is not None:
-            self.nvim.out_write(tpe + "\n")
-        else:
-            self.error("server error when getting type under cursor")
+        self.echo_info_at("/ask-type-at", "type")
 
     @pynvim.command("ScalavistaKind")
     def get_kind_at(self):
-        kind = self.get_info_at("/ask-kind-at")
-        if kind is not None:
-            self.nvim.out_write(kind + "\n")
-        else:
-            self.error("server error when getting kind under cursor")
+        self.echo_info_at("/ask-kind-at", "kind")
 
     @pynvim.command("ScalavistaFullyQualifiedName")
     def get_fully_qualified_name_at(self):
-        fqn = self.get_info_at("/ask-fully-qualified-name-at")
-        if fqn is not None:
-            self.nvim.out_write(fqn + "\n")
-        else:
-            self.error("server error when getting fully qualified name under cursor")
-
-    def get_info_at(self, endpoint):
-        if not self.server_alive:
-            return
-        window = self.nvim.current.window
-        cursor = window.cursor
-        buf = self.nvim.current.buffer
-        offset = get_offset_from_cursor(buf[:], cursor)
-        content = "\n".join(buf)
-        file_name = self.nvim.call("expand", "%:p")
-        data = {"filename": file_name, "fileContents": content, "offset": offset}
-        resp = requests.post(self.server_url() + endpoint, json=data)
-        if resp.status_code == requests.codes.ok:
-            return resp.text
-        else:
-            return None
+        self.echo_info_at("/ask-fully-qualified-name-at", "fully qualified name")
 
     @pynvim.command("ScalavistaGoto")
     def get_pos(self):
-        if not self.server_alive:
-            return
-        window = self.nvim.current.window
-        cursor = window.cursor
-        buf = self.nvim.current.buffer
-        offset = get_offset_from_cursor(buf[:], cursor)
-        content = "\n".join(buf)
         current_file = self.nvim.call("expand", "%:p")
-        data = {"filename": current_file, "fileContents": content, "offset": offset}
-        resp = requests.post(self.server_url() + "/ask-pos-at", json=data)
-        if resp.status_code == requests.codes.ok:
-            file = resp.json()["file"]
-            line = resp.json()["line"]
-            col = resp.json()["column"]
-            symbol = resp.json()["symbol"]
+        word = self.nvim.call("expand", "<cword>")
+        project = self.current_project()
+        if project is None:
+            return
+        if not project.alive:
+            # the server is still starting - the local index is better than nothing
+            self.goto_symbol_fallback(word)
+            return
+        self.ask_at_cursor(
+            "/ask-pos-at",
+            functools.partial(self.jump_to_pos, project.client, current_file, word),
+        )
+
+    def jump_to_pos(self, client, current_file, word, resp):
+        if resp is not None:
+            pos = client.decode("/ask-pos-at", resp)
+            file = pos["file"]
+            line = pos["line"]
+            col = pos["column"]
             if file and file != "<no source file>":
                 try:
                     if (file != current_file) and (file != "<no file>"):
@@ -583,24 +3510,21 @@ class Scalavista(object):
                 except Exception as e:
                     self.error(e)
             else:
-                self.error("unable to find definition of {}".format(symbol))
+                self.goto_symbol_fallback(word)
         else:
-            self.error("goto failed")
+            self.goto_symbol_fallback(word)
 
     @pynvim.command("ScalavistaDoc")
     def get_doc(self):
-        if not self.server_alive:
-            return
-        window = self.nvim.current.window
-        cursor = window.cursor
-        buf = self.nvim.current.buffer
-        offset = get_offset_from_cursor(buf[:], cursor)
-        content = "\n".join(buf)
-        current_file = self.nvim.call("expand", "%:p")
-        data = {"filename": current_file, "fileContents": content, "offset": offset}
-        resp = requests.post(self.server_url() + "/ask-doc-at", json=data)
-        if resp.status_code == requests.codes.ok:
-            doc_string = resp.text
+        project = self.current_project()
+        if project is not None:
+            self.ask_at_cursor(
+                "/ask-doc-at", functools.partial(self.show_doc, project.client)
+            )
+
+    def show_doc(self, client, resp):
+        if resp is not None:
+            doc_string = client.text("/ask-doc-at", resp)
             if not doc_string:
                 # self.error("no scaladoc found")
                 return
@@ -618,25 +3542,79 @@ class Scalavista(object):
         else:
             self.error("failed to retrieve scaladoc")
 
+    @pynvim.command("ScalavistaStats", nargs="*", complete="file")
+    def show_stats(self, args):
+        if args and args[0] == "reset":
+            self.stats.reset()
+        elif args and args[0] == "trace":
+            if len(args) > 1:
+                self.stats.start_trace(os.path.expanduser(args[1]))
+                self.notify("tracing to {}".format(args[1]))
+            else:
+                self.stats.stop_trace()
+                self.notify("tracing stopped")
+        else:
+            rows, counters = self.stats.summary()
+            lines = [
+                "{:<40} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+                    "phase", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"
+                )
+            ]
+            for name, count, percentiles, maximum in rows:
+                lines.append(
+                    "{:<40} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                        name, count, *[1000 * v for v in percentiles + [maximum]]
+                    )
+                )
+            for name in sorted(counters):
+                lines.append("{:<40} {:>7}".format(name, counters[name]))
+            self.nvim.out_write("\n".join(lines) + "\n")
+
     @pynvim.command("ScalavistaErrors")
     def scala_errors(self):
         self.update_errors_and_populate_quickfix()
 
+    # runs on a worker thread - must not touch self.nvim
+    def probe_health_and_version(self, project, was_alive):
+        health = self.probe_health(project, was_alive)
+        if health is None:
+            return None, None, False
+        return (
+            health,
+            self.fetch_server_version(project.client),
+            self.server_version_is_outdated(project.client),
+        )
+
     @pynvim.command("ScalavistaHealth")
     def scalavista_healthcheck(self):
-        self.check_health()
-        if self.server_alive:
-            server_version = self.get_server_version()
+        project = self.current_project()
+        if project is None:
+            return
+        self.run_async(
+            project.client,
+            self.probe_health_and_version,
+            functools.partial(self.report_health, project),
+            None,
+            project,
+            project.alive,
+        )
+
+    def report_health(self, project, result):
+        health, server_version, outdated = result
+        self.apply_health(project, health)
+        if project.alive:
             self.notify(
                 "scalavista server version {} at {} is alive".format(
-                    server_version, self.server_url()
+                    server_version, project.server_url()
                 )
             )
         else:
             self.error(
-                "unable to connect to scalavista server at {}".format(self.server_url())
+                "unable to connect to scalavista server at {}".format(
+                    project.server_url()
+                )
             )
-        if self.server_version_is_outdated():
+        if outdated:
             self.notify(
                 "your scalavista server version is outdated - consider updating using :ScalavistaDownloadServerJars"
             )
@@ -645,43 +3623,87 @@ class Scalavista(object):
         "BufEnter", pattern="*.scala,*.java", eval='expand("<afile>")', sync=True
     )
     def on_buf_enter(self, filename):
-        self.initialize()
-        self.reload_current_buffer()
+        if not self.initialize():
+            return
+        project = self.current_project()
+        self.activate_project(project)
+        self.symbol_index_for(project)
+        self.sync_current_buffer()
+        self.render_pending_diagnostics(
+            self.nvim.call("expand", "%:p"), self.nvim.current.buffer.number
+        )
 
     @pynvim.autocmd(
         "BufLeave", pattern="*.scala,*.java", eval='expand("<afile>")', sync=True
     )
     def on_buf_leave(self, filename):
-        self.reload_current_buffer()
+        self.sync_current_buffer()
 
     @pynvim.autocmd(
         "VimLeavePre", pattern="*.scala,*.java", eval='expand("<afile>")', sync=True
     )
     def on_vim_leave(self, filename):
-        self.nvim.call("timer_stop", self.refresh_timer)
-        self.nvim.call("timer_stop", self.server_start_timer)
+        for timer in [self.refresh_timer, self.server_start_timer, self.fill_timer]:
+            if timer is not None:
+                self.nvim.call("timer_stop", timer)
         # the next line is a hack: when we exit nvim then 'on_exit' is called
         # on the server process, but the 'ScalavistaServerFailed' callback
         # is a rpc whose channel no longer exist so we have to overwrite the
         # function with a no-op.
         self.nvim.command("function! ScalavistaServerFailed(a, b, c)\nendfunction")
-        self.stop_server()
-
-    @pynvim.autocmd("TextChanged", pattern="*.scala,*.java")
-    def on_text_changed(self):
-        self.reload_current_buffer()
-
-    @pynvim.autocmd("TextChangedI", pattern="*.scala,*.java")
-    def on_text_changed_i(self):
-        self.reload_current_buffer()
-
-    @pynvim.autocmd("CursorMoved", pattern="*.scala,*.java")
-    def on_cursor_moved(self):
-        line_num = self.nvim.current.window.cursor[0]
-        buf_num = self.nvim.current.buffer.number
-        messages = []
-        for item in self.qflist:
-            if (item["bufnr"] == buf_num) and (item["lnum"] == line_num):
-                messages.append(item["text"])
-        if messages:
-            self.nvim.out_write(" | ".join(messages) + "\n")
+        for project in self.projects.values():
+            if project.registry is not None:
+                self.detach_shared_server(project)
+            else:
+                self.stop_server(project)
+            project.client.close()
+        self.stats.stop_trace()
+        if self.log is not None:
+            self.log.close()
+
+    @pynvim.autocmd(
+        "BufWritePost", pattern="*.scala,*.java", eval='expand("<afile>:p")'
+    )
+    def on_buf_write_post(self, filename):
+        if not self.initialized:
+            return
+        index = self.symbol_index_for(self.project_for(filename))
+        if index is not None:
+            threading.Thread(
+                target=index.index_files, args=([filename],), daemon=True
+            ).start()
+
+    @pynvim.autocmd("CursorHold", pattern="*.scala,*.java")
+    def on_cursor_hold(self):
+        if self.prefetch_type:
+            self.ask_at_cursor("/ask-type-at", lambda resp: None)
+
+    @pynvim.autocmd("WinScrolled", pattern="*")
+    def on_win_scrolled(self):
+        if self.lazy_diagnostics:
+            self.render_visible_diagnostics()
+
+    @pynvim.autocmd("InsertLeave", pattern="*.scala,*.java")
+    def on_insert_leave(self):
+        if self.errors_stale:
+            self.update_errors_and_populate_quickfix()
+
+    @pynvim.autocmd(
+        "CursorMoved",
+        pattern="*.scala,*.java",
+        eval='[expand("%:p"), line("."), bufnr("%")]',
+    )
+    def on_cursor_moved(self, args):
+        path, lnum, bufnr = args
+        state = self.sync_states.get(bufnr)
+        if state is not None:
+            # reading code counts as use too
+            self.activate_project(state.project)
+        position = (path, lnum)
+        message = self.diagnostics_message(*position)
+        if message is None:
+            self.last_echoed = None
+        elif (position, message) != self.last_echoed:
+            # moving along the same line shouldn't repeat the message
+            self.last_echoed = (position, message)
+            self.nvim.out_write(message + "\n")